@@ -0,0 +1,387 @@
+import argparse
+import os
+import sys
+import time
+from array import array
+
+from main import HackAssembler, load_rom
+
+RAM_SIZE = 32768
+SCREEN = 16384
+KBD = 24576
+
+
+# Computes the Hack ALU output from its six control bits, as in project2/ALU.hdl
+def alu(x, y, control):
+    zx, nx, zy, ny, f, no = ((control >> bit) & 1 for bit in range(5, -1, -1))
+    if zx:
+        x = 0
+    if nx:
+        x = ~x & 0xFFFF
+    if zy:
+        y = 0
+    if ny:
+        y = ~y & 0xFFFF
+    out = (x + y) & 0xFFFF if f else x & y
+    if no:
+        out = ~out & 0xFFFF
+    return out
+
+
+# Fast paths for the comp codes the assembler can produce, keyed by the six ALU control bits
+# x is D and y is A or M; every result is an unsigned 16-bit value
+ALU_FUNCTIONS = {
+    0b101010: lambda x, y: 0,
+    0b111111: lambda x, y: 1,
+    0b111010: lambda x, y: 0xFFFF,
+    0b001100: lambda x, y: x,
+    0b110000: lambda x, y: y,
+    0b001101: lambda x, y: ~x & 0xFFFF,
+    0b110001: lambda x, y: ~y & 0xFFFF,
+    0b001111: lambda x, y: -x & 0xFFFF,
+    0b110011: lambda x, y: -y & 0xFFFF,
+    0b011111: lambda x, y: (x + 1) & 0xFFFF,
+    0b110111: lambda x, y: (y + 1) & 0xFFFF,
+    0b001110: lambda x, y: (x - 1) & 0xFFFF,
+    0b110010: lambda x, y: (y - 1) & 0xFFFF,
+    0b000010: lambda x, y: (x + y) & 0xFFFF,
+    0b010011: lambda x, y: (x - y) & 0xFFFF,
+    0b000111: lambda x, y: (y - x) & 0xFFFF,
+    0b000000: lambda x, y: x & y,
+    0b010101: lambda x, y: x | y,
+}
+
+
+# The same operations as Python expression templates, for BlockCompiler
+ALU_EXPRESSIONS = {
+    0b101010: '0',
+    0b111111: '1',
+    0b111010: '0xFFFF',
+    0b001100: '{x}',
+    0b110000: '{y}',
+    0b001101: '~{x} & 0xFFFF',
+    0b110001: '~{y} & 0xFFFF',
+    0b001111: '-{x} & 0xFFFF',
+    0b110011: '-{y} & 0xFFFF',
+    0b011111: '({x} + 1) & 0xFFFF',
+    0b110111: '({y} + 1) & 0xFFFF',
+    0b001110: '({x} - 1) & 0xFFFF',
+    0b110010: '({y} - 1) & 0xFFFF',
+    0b000010: '({x} + {y}) & 0xFFFF',
+    0b010011: '({x} - {y}) & 0xFFFF',
+    0b000111: '({y} - {x}) & 0xFFFF',
+    0b000000: '{x} & {y}',
+    0b010101: '{x} | {y}',
+}
+
+# Python conditions on the ALU output for each jump field
+JUMP_CONDITIONS = {1: '0 < out < 0x8000', 2: 'out == 0', 3: 'out < 0x8000', 4: 'out >= 0x8000', 5: 'out != 0',
+                   6: 'out == 0 or out >= 0x8000', 7: 'True'}
+
+
+def alu_function(control):
+    if control in ALU_FUNCTIONS:
+        return ALU_FUNCTIONS[control]
+    return lambda x, y: alu(x, y, control)
+
+
+# Decodes one ROM word. A-instructions stay plain ints (the value loaded into A); C-instructions become a tuple
+# (reads M, ALU function, writes A, writes D, writes M, jump bits)
+# The jump bits are tested against 4 for a negative output, 2 for zero and 1 for positive
+def decode(word):
+    if not word & 0x8000:
+        return word
+    return (bool(word & 0x1000), alu_function((word >> 6) & 0x3F),
+            bool(word & 0x20), bool(word & 0x10), bool(word & 0x8), word & 0x7)
+
+
+# Reads a program as a list of ROM words from .hack text, a packed .rom image or .asm source
+def load_program(path):
+    base, extension = os.path.splitext(path)
+    if extension == '.rom':
+        return list(load_rom(path))
+    if extension == '.asm':
+        assembler = HackAssembler(base, output_format=None)
+        assembler.initialize()
+        assembler.first_pass()
+        assembler.second_pass()
+        return assembler.res
+    with open(path, 'r', encoding="utf-8") as file:
+        return [int(line, 2) for line in (line.strip() for line in file) if line]
+
+
+# Translates runs of ROM words into Python functions, one per entry address execution reaches
+# A block follows the fall-through path of conditional jumps and the target of unconditional jumps to known
+# addresses, and ends at a jump whose target is only known at run time, at the end of the ROM or after MAX_LENGTH
+# instructions. Jumps back to the entry address become a Python loop while the cycle budget allows another full
+# pass. Each block compiles to
+#   def block(a, d, ram, budget): ... return a, d, next_pc, executed
+# with one return per exit, and with A values that are known at compile time folded into the memory accesses and
+# jump targets
+# With profile=True every exit also counts its hits in exit_hits, and exit_paths holds the ROM addresses executed
+# on the way to it, so that one counter per exit gives exact per-address counts (see CPUEmulator.address_counts)
+class BlockCompiler:
+    MAX_LENGTH = 256
+
+    def __init__(self, rom, profile=False):
+        self.rom = rom
+        self.profile = profile
+        self.exit_hits = array('Q')
+        self.exit_paths = []
+
+    # Returns (function, most instructions executed by one pass through the block) for the block at ROM[start]
+    def compile(self, start):
+        lines = []
+        a = None  # compile-time value of A, None when it is only known at run time
+        pc = start
+        executed = 0
+        visited = set()
+        path = []
+
+        def leave(indent, target):
+            body = [] if a is None else [f'a = {a}']
+            if self.profile:
+                body.append(f'hits[{len(self.exit_paths)}] += 1')
+                self.exit_paths.append(tuple(path))
+                self.exit_hits.append(0)
+            if target == str(start):
+                body += [f'n += {executed}',
+                         'if n + {length} <= budget:',
+                         '    continue',
+                         f'return a, d, {start}, n']
+            else:
+                body.append(f'return a, d, {target}, n + {executed}')
+            lines.extend(indent + line for line in body)
+
+        while True:
+            if pc >= len(self.rom) or executed >= self.MAX_LENGTH or pc in visited:
+                leave('        ', str(pc))
+                break
+
+            visited.add(pc)
+            path.append(pc)
+            word = self.rom[pc]
+            pc += 1
+            executed += 1
+
+            if not word & 0x8000:
+                a = str(word)
+                continue
+
+            address = 'a' if a is None else a
+            control = (word >> 6) & 0x3F
+            y = f'ram[{address}]' if word & 0x1000 else address
+            if control in ALU_EXPRESSIONS:
+                expression = ALU_EXPRESSIONS[control].format(x='d', y=y)
+            else:
+                expression = f'alu(d, {y}, {control})'
+
+            jump = word & 0x7
+            target = address
+            # M is written before A changes, and a jump needs the old A
+            destinations = []
+            if word & 0x8:
+                destinations.append(f'ram[{address}]')
+            if word & 0x10:
+                destinations.append('d')
+            if word & 0x20:
+                if jump and a is None:
+                    lines.append('        target = a')
+                    target = 'target'
+                destinations.append('a')
+                a = None
+
+            if jump or len(destinations) > 1:
+                lines.append(f'        out = {expression}')
+                lines.extend(f'        {destination} = out' for destination in destinations)
+            elif destinations:
+                lines.append(f'        {destinations[0]} = {expression}')
+
+            if not jump:
+                continue
+
+            if jump == 7 and target.isdigit() and target != str(start):
+                # Unconditional jump to a known address: keep compiling there
+                pc = int(target)
+                continue
+
+            if jump == 7:
+                leave('        ', target)
+                break
+
+            lines.append(f'        if {JUMP_CONDITIONS[jump]}:')
+            leave('            ', target)
+
+        source = '\n'.join([f'def block_{start}(a, d, ram, budget):', '    n = 0', '    while True:'] + lines)
+        namespace = {'alu': alu, 'hits': self.exit_hits}
+        exec(compile(source.replace('{length}', str(executed)), f'<block {start}>', 'exec'), namespace)
+        return namespace[f'block_{start}'], executed
+
+
+# Executes Hack machine code the way project5/Computer.hdl does
+# RAM, SCREEN and KBD share one array of RAM_SIZE unsigned 16-bit words, and each ROM word is decoded once on load
+# With profile=True, run counts the executions of each ROM address in counts and run_compiled counts block exits,
+# and address_counts adds the two up
+class CPUEmulator:
+    def __init__(self, rom=(), profile=False):
+        self.ram = array('H', bytes(2 * RAM_SIZE))
+        self.rom = []
+        self.program = []
+        self.a = 0
+        self.d = 0
+        self.pc = 0
+        self.cycles = 0
+        self.blocks = []
+        self.compiler = None
+        self.profile = profile
+        self.counts = None
+        self.load(rom)
+
+    def load(self, rom):
+        self.rom = list(rom)
+        self.program = [decode(word) for word in self.rom]
+        # Compiled blocks are built lazily by run_compiled, indexed by their start address
+        self.blocks = [None] * len(self.rom)
+        self.compiler = BlockCompiler(self.rom, self.profile)
+        self.reset()
+
+    # Clears the registers, the cycle count and the profile counts; RAM keeps its contents, as with the reset pin
+    # of the Computer chip
+    def reset(self):
+        self.a = 0
+        self.d = 0
+        self.pc = 0
+        self.cycles = 0
+        if self.profile:
+            self.counts = array('Q', bytes(8 * len(self.rom)))
+            # In place, since the compiled blocks hold on to the array
+            self.compiler.exit_hits[:] = array('Q', bytes(8 * len(self.compiler.exit_hits)))
+
+    # Returns how many times each ROM address was executed since the last reset, as a list indexed by address
+    def address_counts(self):
+        counts = list(self.counts)
+        for path, hits in zip(self.compiler.exit_paths, self.compiler.exit_hits):
+            if hits:
+                for address in path:
+                    counts[address] += hits
+        return counts
+
+    # Returns RAM[address] as a signed 16-bit value
+    def peek(self, address):
+        value = self.ram[address]
+        return value - 0x10000 if value & 0x8000 else value
+
+    # Stores a (possibly negative) value in RAM[address]
+    def poke(self, address, value):
+        self.ram[address] = value & 0xFFFF
+
+    def set_key(self, code):
+        self.ram[KBD] = code
+
+    # Whether the program counter still points inside the loaded program
+    def running(self):
+        return self.pc < len(self.program)
+
+    # Executes up to max_cycles instructions, stopping early if the program counter leaves the ROM
+    # Returns the number of instructions executed
+    def run(self, max_cycles):
+        ram = self.ram
+        program = self.program
+        size = len(program)
+        counts = self.counts
+        a, d, pc = self.a, self.d, self.pc
+        executed = 0
+
+        try:
+            while executed < max_cycles and pc < size:
+                instruction = program[pc]
+                executed += 1
+                if counts is not None:
+                    counts[pc] += 1
+
+                if instruction.__class__ is int:
+                    a = instruction
+                    pc += 1
+                    continue
+
+                reads_m, compute, writes_a, writes_d, writes_m, jump = instruction
+                out = compute(d, ram[a] if reads_m else a)
+                if writes_m:
+                    ram[a] = out
+                # Registers latch on the clock edge, so the jump target is the A value from before this instruction
+                target = a
+                if writes_a:
+                    a = out
+                if writes_d:
+                    d = out
+                if jump and jump & (4 if out & 0x8000 else 2 if out == 0 else 1):
+                    pc = target
+                else:
+                    pc += 1
+        except IndexError:
+            executed -= 1
+            raise RuntimeError(f'ROM[{pc}]: memory access out of range (A={a})') from None
+        finally:
+            self.a, self.d, self.pc = a, d, pc
+            self.cycles += executed
+
+        return executed
+
+    # Same as run, but executes whole compiled blocks at a time, compiling each block the first time it is reached
+    # The last few cycles before max_cycles fall back to run when the next block could overshoot the limit
+    def run_compiled(self, max_cycles):
+        ram = self.ram
+        blocks = self.blocks
+        size = len(blocks)
+        a, d, pc = self.a, self.d, self.pc
+        executed = 0
+
+        try:
+            while pc < size:
+                block = blocks[pc]
+                if block is None:
+                    block = blocks[pc] = self.compiler.compile(pc)
+                function, length = block
+                if executed + length > max_cycles:
+                    break
+                a, d, pc, length = function(a, d, ram, max_cycles - executed)
+                executed += length
+        except IndexError:
+            raise RuntimeError(f'block at ROM[{pc}]: memory access out of range') from None
+        finally:
+            self.a, self.d, self.pc = a, d, pc
+            self.cycles += executed
+
+        if executed < max_cycles:
+            executed += self.run(max_cycles - executed)
+        return executed
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description='Runs a Hack program (.hack, .rom or .asm).')
+    arg_parser.add_argument('program')
+    arg_parser.add_argument('-n', '--cycles', type=int, default=1_000_000, help='cycle limit (default: %(default)s)')
+    arg_parser.add_argument('--compiled', action='store_true', help='run compiled basic blocks instead of interpreting')
+    arg_parser.add_argument('--set', nargs=2, type=int, action='append', default=[], metavar=('ADDRESS', 'VALUE'),
+                            help='initial RAM value, may be repeated')
+    arg_parser.add_argument('--dump', type=int, nargs='*', default=list(range(16)), metavar='ADDRESS',
+                            help='RAM addresses printed after the run (default: R0-R15)')
+    args = arg_parser.parse_args(argv)
+
+    emulator = CPUEmulator(load_program(args.program))
+    for address, value in args.set:
+        emulator.poke(address, value)
+
+    start = time.perf_counter()
+    executed = emulator.run_compiled(args.cycles) if args.compiled else emulator.run(args.cycles)
+    elapsed = time.perf_counter() - start
+
+    for address in args.dump:
+        print(f'RAM[{address}] = {emulator.peek(address)}')
+    print(f'{executed} cycles in {elapsed:.3f}s ({executed / elapsed / 1e6 if elapsed else 0:.2f}M cycles/s), '
+          f'pc={emulator.pc}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
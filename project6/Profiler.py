@@ -0,0 +1,186 @@
+import argparse
+import bisect
+import os
+import sys
+import time
+
+from CPUEmulator import CPUEmulator, load_program
+from main import SourceMap
+
+# Cycles between two call stack samples
+SAMPLE_INTERVAL = 10_000
+# Longest call stack walked from the frames in RAM, so that a corrupt frame chain cannot loop forever
+MAX_DEPTH = 1024
+# Most single steps taken after a sample point to reach the start of a VM command
+MAX_ALIGN = 1000
+
+ARITHMETIC_COMMANDS = {'add', 'sub', 'neg', 'eq', 'gt', 'lt', 'and', 'or', 'not'}
+
+
+# Reports where the cycles of a translated program go, by VM function and by the kind of VM command (push, pop,
+# call, return, arithmetic, ...) that CodeWriter generated each ROM address for
+# Exact per-address counts come from the CPUEmulator profile counters and the source maps (see SourceMap in
+# main.py). Code that no VM command produced, such as the bootstrap and the shared routines, is reported as the
+# (runtime) function, under the name of the .asm label it follows when the .asm file is there.
+# Call stacks for the collapsed-stack output are sampled every sample_interval cycles, at the start of a VM
+# command, by walking the frames the VM calling convention saves in RAM
+class Profiler:
+    def __init__(self, program_path):
+        self.emulator = CPUEmulator(load_program(program_path), profile=True)
+        self.source_map = SourceMap(program_path)
+        self.directory = os.path.dirname(os.path.abspath(program_path))
+        self.vm_files = {}
+        self.stacks = {}
+
+        labels = self.read_labels(os.path.splitext(program_path)[0] + '.asm')
+        label_lines = [line_num for line_num, _ in labels]
+
+        # Per ROM address: (function, command kind, VM file:line, command text), with function None for runtime code
+        self.commands = []
+        # Per ROM address: whether a VM command starts there, the points at which the frames in RAM are consistent
+        self.boundaries = bytearray(len(self.emulator.rom))
+        previous = None
+        for address in range(len(self.emulator.rom)):
+            source = self.source_map.vm_source(address)
+            if source is None:
+                asm_line = self.source_map.asm_line(address)
+                position = bisect.bisect_right(label_lines, asm_line) - 1 if asm_line is not None else -1
+                self.commands.append((None, labels[position][1] if position >= 0 else 'bootstrap', '', ''))
+            else:
+                file, vm_line, function = source
+                text = self.vm_line(file, vm_line)
+                self.commands.append((function, self.command_kind(text), f'{file}:{vm_line}', text))
+                self.boundaries[address] = source != previous
+            previous = source
+
+    # Returns [(line number, label)] for the label definitions in an .asm file, with the shared routines' inner
+    # labels (such as VM$EQ.TRUE) folded into the routine, or [] when the file is not there
+    @staticmethod
+    def read_labels(path):
+        if not os.path.exists(path):
+            return []
+        labels = []
+        with open(path, 'r', encoding="utf-8") as file:
+            for line_num, line in enumerate(file, start=1):
+                line = line.split('//', 1)[0].strip()
+                if line.startswith('('):
+                    label = line[1:-1]
+                    labels.append((line_num, label.split('.')[0] if label.startswith('VM$') else label))
+        return labels
+
+    def vm_line(self, file, vm_line):
+        if file not in self.vm_files:
+            path = os.path.join(self.directory, file)
+            if os.path.exists(path):
+                with open(path, 'r', encoding="utf-8") as vm_file:
+                    self.vm_files[file] = [line.split('//', 1)[0].strip() for line in vm_file]
+            else:
+                self.vm_files[file] = []
+        lines = self.vm_files[file]
+        return lines[vm_line - 1] if vm_line is not None and 0 < vm_line <= len(lines) else '?'
+
+    @staticmethod
+    def command_kind(text):
+        word = text.split(' ', 1)[0]
+        return 'arithmetic' if word in ARITHMETIC_COMMANDS else word
+
+    # Runs the program for up to max_cycles, sampling the call stack every sample_interval cycles
+    # Returns the number of cycles executed
+    def run(self, max_cycles, compiled=False, sample_interval=SAMPLE_INTERVAL):
+        emulator = self.emulator
+        run = emulator.run_compiled if compiled else emulator.run
+        executed = 0
+        while executed < max_cycles and emulator.running():
+            cycles = run(min(sample_interval, max_cycles - executed))
+            # Step to the start of a VM command, where LCL is the frame of the function at pc
+            for _ in range(MAX_ALIGN):
+                if executed + cycles >= max_cycles or not emulator.running() or self.boundaries[emulator.pc]:
+                    break
+                cycles += emulator.run(1)
+            executed += cycles
+            stack = self.call_stack()
+            self.stacks[stack] = self.stacks.get(stack, 0) + cycles
+        return executed
+
+    # Returns the current VM call stack as 'outermost;...;innermost', following the saved LCL and return address
+    # of each frame until one returns into code that no VM function produced, such as the bootstrap
+    def call_stack(self):
+        ram = self.emulator.ram
+        pc = self.emulator.pc
+        leaf = self.commands[pc][0] if pc < len(self.commands) else None
+        stack = [leaf or '(runtime)']
+        frame = ram[1]
+        while len(stack) < MAX_DEPTH and 5 <= frame < len(ram):
+            # The return address points just past the caller's call command
+            return_address = ram[frame - 5]
+            if not 0 < return_address <= len(self.commands) or self.commands[return_address - 1][0] is None:
+                break
+            stack.append(self.commands[return_address - 1][0])
+            frame = ram[frame - 4]
+        return ';'.join(reversed(stack))
+
+    # Returns {key: cycles} for the executed ROM addresses, with key(command) picking the fields to group by
+    def totals(self, key):
+        totals = {}
+        for command, count in zip(self.commands, self.emulator.address_counts()):
+            if count:
+                group = key(command)
+                totals[group] = totals.get(group, 0) + count
+        return totals
+
+    # Returns the hot-spot report: cycles by function, by command kind and by VM command, most cycles first
+    def report(self, top=20):
+        total = self.emulator.cycles or 1
+        sections = [
+            ('function', self.totals(lambda command: command[0] or '(runtime)')),
+            ('command', self.totals(lambda command: command[1])),
+            ('VM command', self.totals(lambda command: (f'{command[0]}  {command[2]}  {command[3]}' if command[0]
+                                                         else f'(runtime)  {command[1]}'))),
+        ]
+        res = []
+        for title, totals in sections:
+            res.append(f'{"cycles":>12} {"%":>6}  {title}')
+            for name, cycles in sorted(totals.items(), key=lambda item: (-item[1], item[0]))[:top]:
+                res.append(f'{cycles:>12} {100 * cycles / total:>6.2f}  {name}')
+            res.append('')
+        return res
+
+    # Writes the sampled call stacks in the collapsed format that flame graph tools read: one 'a;b;c cycles' line
+    # per distinct stack
+    def write_collapsed(self, path):
+        with open(path, 'w', encoding="utf-8") as file:
+            for stack, cycles in sorted(self.stacks.items()):
+                file.write(f'{stack} {cycles}\n')
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description='Profiles a translated VM program (.hack, .rom or .asm with '
+                                                     'source maps) by VM function and command.')
+    arg_parser.add_argument('program')
+    arg_parser.add_argument('-n', '--cycles', type=int, default=1_000_000, help='cycle limit (default: %(default)s)')
+    arg_parser.add_argument('--compiled', action='store_true', help='run compiled basic blocks instead of interpreting')
+    arg_parser.add_argument('--set', nargs=2, type=int, action='append', default=[], metavar=('ADDRESS', 'VALUE'),
+                            help='initial RAM value, may be repeated')
+    arg_parser.add_argument('--top', type=int, default=20, help='rows per report section (default: %(default)s)')
+    arg_parser.add_argument('--sample-interval', type=int, default=SAMPLE_INTERVAL,
+                            help='cycles between call stack samples (default: %(default)s)')
+    arg_parser.add_argument('--collapsed', metavar='PATH', help='write the sampled call stacks for flame graph tools')
+    args = arg_parser.parse_args(argv)
+
+    profiler = Profiler(args.program)
+    for address, value in args.set:
+        profiler.emulator.poke(address, value)
+
+    start = time.perf_counter()
+    executed = profiler.run(args.cycles, args.compiled, args.sample_interval)
+    elapsed = time.perf_counter() - start
+
+    print('\n'.join(profiler.report(args.top)))
+    print(f'{executed} cycles in {elapsed:.3f}s')
+    if args.collapsed:
+        profiler.write_collapsed(args.collapsed)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,28 +1,65 @@
+import argparse
+import bisect
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import struct
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from array import array
 from enum import Enum
 
+# Packed ROM image: magic, format version, reserved, word count, then the words as little-endian uint16
+ROM_MAGIC = b'HROM'
+ROM_VERSION = 1
+ROM_HEADER = struct.Struct('<4sHHI')
 
-# prog.asm -> prog.hack
+# Part of every assembly cache key: bump it whenever a change to the assembler alters its output
+ASSEMBLER_VERSION = '2'
+
+# Source maps are JSON side-car files, written next to their outputs with a .map suffix:
+#   prog.hack.map (or prog.rom.map), by HackAssembler with source_map=True:
+#     {"version": 1, "source": "prog.asm", "asm_lines": [...]}, the 1-based .asm line of each ROM address
+#   prog.asm.map, by project8/VMTranslator.py with source_map=True:
+#     {"version": 1, "files": [...], "functions": [...], "ranges": [[first .asm line, file, VM line, function], ...]}
+#     with files and functions as indices into the lists, -1 for none. The ranges are sorted by .asm line, and each
+#     one runs up to the next
+SOURCE_MAP_VERSION = 1
+
+
+# prog.asm -> prog.hack (or prog.rom with output_format='rom')
 class HackAssembler:
-    def __init__(self, file):
+    # In streaming mode the source is read from disk once per pass and each word is written out as soon as
+    # it is assembled, so peak memory depends on the symbol table instead of on the program length
+    # With output_format=None nothing is written and the words are only kept in res
+    # With source_map=True the .asm line of each word is kept in rom_lines, and written to prog.hack.map
+    def __init__(self, file, streaming=False, output_format='hack', source_map=False):
+        if output_format is not None and output_format not in OUTPUT_WRITERS:
+            raise ValueError(f'unknown output format {output_format!r}, expected one of {sorted(OUTPUT_WRITERS)}')
         self.symbol_table = None
         self.parser = None
         self.code = Code()
         self.res = []
         self.current_file = file
+        self.streaming = streaming
+        self.output_format = output_format
+        self.source_map = source_map
+        self.rom_lines = []
 
     # Opens the input file (prog.asm) and gets ready to process it
     # Constructs a symbol table, and adds to it all the predefined symbols
-    def initialize(self):
-        with open(self.current_file + '.asm', 'r', encoding="utf-8") as file:
-            lines_temp = file.readlines()
-
-        lines = []
-        for line in lines_temp:
-            if not line.strip().startswith('//') and line.strip():
-                lines.append(line.strip())
-        # print(lines, len(lines))
-
-        self.parser = Parser(lines)
+    # With lines, assembles those stripped source lines (no comments or blank lines) instead of reading prog.asm;
+    # line_nums are then their line numbers in the .asm, for the source map
+    def initialize(self, lines=None, line_nums=None):
+        if lines is not None:
+            self.parser = Parser(lines, line_nums)
+        elif self.streaming:
+            self.parser = StreamingParser(self.current_file + '.asm')
+        else:
+            numbered = list(read_numbered_lines(self.current_file + '.asm'))
+            self.parser = Parser([line for _, line in numbered], [line_num for line_num, _ in numbered])
         self.symbol_table = SymbolTable()
 
     # Reads the program lines, one by one, focusing only on (label) declarations.
@@ -33,8 +70,9 @@ class HackAssembler:
         while self.parser.has_more_lines():
             self.parser.advance()
 
-            if self.parser.instruction_type() == InstructionType.L_INSTRUCTION:
-                symbol = self.parser.symbol()
+            instruction = self.parser.current_instruction
+            if instruction.kind == InstructionType.L_INSTRUCTION:
+                symbol = instruction.symbol
                 if not symbol.isdigit():
                     self.symbol_table.add_entry(symbol, self.parser.line_num - line_num_to_reduce)
                     line_num_to_reduce += 1
@@ -48,46 +86,164 @@ class HackAssembler:
     #     Translates the symbol into its binary value
     #   If the instruction is dest =comp ; jump
     #     Translates each of the three fields into its binary value
-    #   Assembles the binary values into a string of sixteen 0’s and 1’s
-    #   Writes the string to the output file.
+    #   Assembles the binary values into a sixteen-bit word
+    #   Writes the word to the output file.
     def second_pass(self):
-        self.parser.line_num = -1
-        while self.parser.has_more_lines():
-            self.parser.advance()
-            self.code.current_string = self.parser.current_line
-
-            if self.parser.instruction_type() == InstructionType.C_INSTRUCTION:
-                dest = self.parser.dest()
-                comp = self.parser.comp()
-                jump = self.parser.jump()
-                res = '111' + self.code.comp(comp) + self.code.dest(dest) + self.code.jump(jump)
-                # print('  res', self.parser.current_line, res)
-                self.res.append(res)
-
-            elif self.parser.instruction_type() == InstructionType.A_INSTRUCTION:
-                symbol = self.parser.symbol()
-                # print('symbol', symbol)
-                if symbol.isdigit():
-                    res = str(bin(int(symbol))[2:]).rjust(16, '0')
-                    self.res.append(res)
-                else:
-                    if self.symbol_table.contains(symbol):
-                        address = self.symbol_table.get_address(symbol)
-                        res = str(bin(address)[2:]).rjust(16, '0')
-                        # print('  res', res)
-                        self.res.append(res)
+        self.parser.reset()
+        with self.open_output() as output:
+            while self.parser.has_more_lines():
+                self.parser.advance()
+                self.code.current_string = self.parser.current_line
+                instruction = self.parser.current_instruction
+
+                if instruction.kind == InstructionType.C_INSTRUCTION:
+                    res = self.code.encode(instruction.dest, instruction.comp, instruction.jump)
+                    # print('  res', self.parser.current_line, res)
+                    self.emit(output, res)
+
+                elif instruction.kind == InstructionType.A_INSTRUCTION:
+                    symbol = instruction.symbol
+                    # print('symbol', symbol)
+                    if symbol.isdigit():
+                        res = int(symbol)
+                        self.emit(output, res)
                     else:
-                        self.symbol_table.current_num += 1
-                        self.symbol_table.add_entry(symbol, self.symbol_table.current_num)
-                        res = str(bin(self.symbol_table.current_num)[2:]).rjust(16, '0')
-                        # print('  res', res)
-                        self.res.append(res)
+                        if self.symbol_table.contains(symbol):
+                            res = self.symbol_table.get_address(symbol)
+                            # print('  res', res)
+                            self.emit(output, res)
+                        else:
+                            self.symbol_table.current_num += 1
+                            self.symbol_table.add_entry(symbol, self.symbol_table.current_num)
+                            res = self.symbol_table.current_num
+                            # print('  res', res)
+                            self.emit(output, res)
+
+            # print('    symbol_table', self.symbol_table.symbol_table)
+
+        if self.source_map and self.output_format is not None:
+            self.write_source_map()
+
+    def write_source_map(self):
+        with open(f'{self.current_file}.{self.output_format}.map', 'w', encoding="utf-8") as file:
+            json.dump({'version': SOURCE_MAP_VERSION, 'source': os.path.basename(self.current_file) + '.asm',
+                       'asm_lines': self.rom_lines}, file, separators=(',', ':'))
+
+    def open_output(self):
+        if self.output_format is None:
+            return NullWriter()
+        return OUTPUT_WRITERS[self.output_format](self.current_file + '.' + self.output_format)
+
+    # Writes one assembled word to the output file, keeping it in res too unless streaming
+    def emit(self, output, word):
+        if not self.streaming:
+            self.res.append(word)
+        if self.source_map:
+            self.rom_lines.append(self.parser.current_line_num)
+        output.write(word)
+
+
+# Writes assembled words as lines of sixteen 0's and 1's, the format the course tools expect
+class HackWriter:
+    def __init__(self, path):
+        self.file = open(path, 'w', encoding="utf-8")
+
+    def write(self, word):
+        self.file.write(format(word, '016b') + '\n')
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# Writes assembled words as a packed ROM image (see ROM_HEADER), buffering them in an array('H')
+# The word count is patched into the header once all words are written
+class RomWriter(HackWriter):
+    BUFFER_WORDS = 4096
+
+    def __init__(self, path):
+        self.file = open(path, 'wb')
+        self.file.write(ROM_HEADER.pack(ROM_MAGIC, ROM_VERSION, 0, 0))
+        self.buffer = array('H')
+        self.words_num = 0
+
+    def write(self, word):
+        self.buffer.append(word)
+        if len(self.buffer) >= self.BUFFER_WORDS:
+            self.flush()
+
+    def flush(self):
+        if sys.byteorder == 'big':
+            self.buffer.byteswap()
+        self.file.write(self.buffer.tobytes())
+        self.words_num += len(self.buffer)
+        self.buffer = array('H')
+
+    def close(self):
+        self.flush()
+        self.file.seek(0)
+        self.file.write(ROM_HEADER.pack(ROM_MAGIC, ROM_VERSION, 0, self.words_num))
+        self.file.close()
+
+
+# Discards the words, for assembling in memory
+class NullWriter(HackWriter):
+    def __init__(self):
+        pass
+
+    def write(self, word):
+        pass
+
+    def close(self):
+        pass
 
-        # print('    symbol_table', self.symbol_table.symbol_table)
 
-        with open(self.current_file + '.hack', 'w', encoding="utf-8") as file:
-            for line in self.res:
-                file.write(line + '\n')
+OUTPUT_WRITERS = {'hack': HackWriter, 'rom': RomWriter}
+
+
+# Memory-maps a packed ROM image and returns its words as a read-only sequence of ints,
+# without parsing or copying the file on little-endian hosts
+def load_rom(path):
+    with open(path, 'rb') as file:
+        if file.seek(0, 2) < ROM_HEADER.size:
+            raise ValueError(f'{path}: too short to be a ROM image')
+        image = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    magic, version, _, words_num = ROM_HEADER.unpack_from(image)
+    if magic != ROM_MAGIC:
+        raise ValueError(f'{path}: not a ROM image (bad magic {magic!r})')
+    if version != ROM_VERSION:
+        raise ValueError(f'{path}: unsupported ROM image version {version}')
+    end = ROM_HEADER.size + 2 * words_num
+    if len(image) < end:
+        raise ValueError(f'{path}: truncated ROM image, expected {words_num} words')
+
+    words = memoryview(image)[ROM_HEADER.size:end].cast('H')
+    if sys.byteorder == 'big':
+        swapped = array('H', words)
+        swapped.byteswap()
+        return swapped
+    return words
+
+
+# Yields the stripped program lines, dropping comments and blank lines
+def read_lines(path):
+    for _, line in read_numbered_lines(path):
+        yield line
+
+
+# Same as read_lines, but yields (1-based line number, line) pairs
+def read_numbered_lines(path):
+    with open(path, 'r', encoding="utf-8") as file:
+        for line_num, line in enumerate(file, start=1):
+            line = line.split('//', 1)[0].strip()
+            if line:
+                yield line_num, line
 
 
 class InstructionType(Enum):
@@ -97,11 +253,37 @@ class InstructionType(Enum):
     L_INSTRUCTION = 4
 
 
+# One pre-decoded assembly line. Parser.tokenize builds it once, and both passes (and any other tool that
+# walks a program) read the fields instead of re-splitting the text
+class Instruction:
+    __slots__ = ('kind', 'dest', 'comp', 'jump', 'symbol')
+
+    def __init__(self, kind, dest=None, comp=None, jump=None, symbol=None):
+        self.kind = kind
+        self.dest = dest
+        self.comp = comp
+        self.jump = jump
+        self.symbol = symbol
+
+    def __repr__(self):
+        return (f'Instruction({self.kind.name}, dest={self.dest!r}, comp={self.comp!r}, jump={self.jump!r}, '
+                f'symbol={self.symbol!r})')
+
+
 class Parser:
-    def __init__(self, lines):
+    # line_nums, when given, are the source line numbers of lines, for source maps
+    def __init__(self, lines, line_nums=None):
         self.current_line = ''
+        self.current_instruction = None
+        self.current_line_num = None
         self.line_num = -1
         self.lines = lines
+        self.line_nums = line_nums
+        # Generated code repeats the same few lines many times, so each distinct line is tokenized once and its
+        # Instruction shared
+        tokens = {}
+        self.instructions = [tokens[line] if line in tokens else tokens.setdefault(line, self.tokenize(line))
+                             for line in lines]
         self.lines_num = len(lines)
 
     def has_more_lines(self):
@@ -110,59 +292,119 @@ class Parser:
     def advance(self):
         self.line_num += 1
         self.current_line = self.lines[self.line_num]
+        self.current_instruction = self.instructions[self.line_num]
+        if self.line_nums is not None:
+            self.current_line_num = self.line_nums[self.line_num]
+
+    # Rewinds to the first line, ready for another pass
+    def reset(self):
+        self.line_num = -1
+        self.current_line = ''
+        self.current_instruction = None
+
+    # Splits a stripped source line into its fields in a single pass
+    @staticmethod
+    def tokenize(line):
+        if line.startswith('@'):
+            return Instruction(InstructionType.A_INSTRUCTION, symbol=line[1:])
+        if line.startswith('('):
+            return Instruction(InstructionType.L_INSTRUCTION, symbol=line[1:-1])
+
+        dest = None
+        jump = None
+        comp = line
+        if '=' in comp:
+            dest, comp = comp.split('=', 1)
+        if ';' in comp:
+            comp, jump = comp.split(';', 1)
+        return Instruction(InstructionType.C_INSTRUCTION, dest, comp, jump)
 
     def instruction_type(self):
-        if self.current_line.startswith('@'):
-            return InstructionType.A_INSTRUCTION
-        if self.current_line.startswith('('):
-            return InstructionType.L_INSTRUCTION
-        return InstructionType.C_INSTRUCTION
+        return self.current_instruction.kind
 
     def symbol(self):
-        if self.instruction_type() == InstructionType.A_INSTRUCTION:
-            return self.current_line[1:]
-        if self.instruction_type() == InstructionType.L_INSTRUCTION:
-            return self.current_line[1:-1]
-        return None
+        return self.current_instruction.symbol
 
     def dest(self):
-        if self.instruction_type() != InstructionType.C_INSTRUCTION:
-            return None
-        return self.current_line.split('=')[0]
+        return self.current_instruction.dest
 
     def comp(self):
-        split = self.current_line.split('=')
-        if len(split) > 1:
-            return split[1].split(';')[0]
-        return self.current_line.split(';')[0]
+        return self.current_instruction.comp
 
     def jump(self):
-        split = self.current_line.split(';')
-        return split[1] if len(split) > 1 else None
+        return self.current_instruction.jump
 
 
+# Parser that reads the source file lazily, one line ahead, instead of holding every line in memory
+class StreamingParser(Parser):
+    def __init__(self, path):
+        super().__init__([])
+        self.path = path
+        self.lines_iter = None
+        self.next_line = None
+        self.reset()
+
+    def has_more_lines(self):
+        return self.next_line is not None
+
+    def advance(self):
+        self.line_num += 1
+        self.current_line_num, self.current_line = self.next_line
+        self.current_instruction = self.tokenize(self.current_line)
+        self.next_line = next(self.lines_iter, None)
+
+    def reset(self):
+        if self.lines_iter is not None:
+            self.lines_iter.close()
+        self.line_num = -1
+        self.current_line = ''
+        self.current_instruction = None
+        self.current_line_num = None
+        self.lines_iter = read_numbered_lines(self.path)
+        self.next_line = next(self.lines_iter, None)
+
+
+# Translates Hack mnemonics into their binary codes
+# Fields are encoded as integers, and each full 16-bit C-instruction word is memoized per (dest, comp, jump) triple
 class Code:
+    COMP_TABLE = {'0': 0b0101010, '1': 0b0111111, '-1': 0b0111010, 'D': 0b0001100, 'A': 0b0110000, 'M': 0b1110000,
+                  '!D': 0b0001101, '!A': 0b0110001, '!M': 0b1110001, '-D': 0b0001111, '-A': 0b0110011,
+                  '-M': 0b1110011, 'D+1': 0b0011111, 'A+1': 0b0110111, 'M+1': 0b1110111, 'D-1': 0b0001110,
+                  'A-1': 0b0110010, 'M-1': 0b1110010, 'D+A': 0b0000010, 'D+M': 0b1000010, 'D-A': 0b0010011,
+                  'D-M': 0b1010011, 'A-D': 0b0000111, 'M-D': 0b1000111, 'D&A': 0b0000000, 'D&M': 0b1000000,
+                  'D|A': 0b0010101, 'D|M': 0b1010101}
+    DEST_TABLE = {None: 0b000, 'null': 0b000, 'M': 0b001, 'D': 0b010, 'DM': 0b011, 'MD': 0b011, 'A': 0b100,
+                  'AM': 0b101, 'MA': 0b101, 'AD': 0b110, 'DA': 0b110, 'ADM': 0b111, 'AMD': 0b111}
+    JUMP_TABLE = {None: 0b000, 'null': 0b000, 'JGT': 0b001, 'JEQ': 0b010, 'JGE': 0b011, 'JLT': 0b100, 'JNE': 0b101,
+                  'JLE': 0b110, 'JMP': 0b111}
+
     def __init__(self):
         self.current_string = ''
-        self.__comp_table = {'0': '0101010', '1': '0111111', '-1': '0111010', 'D': '0001100', 'A': '0110000',
-                             'M': '1110000', '!D': '0001100', '!A': '0110001', '!M': '1110001', '-D': '0001111',
-                             '-A': '0110011', '-M': '1110001', 'D+1': '0011111', 'A+1': '0110111', 'M+1': '1110111',
-                             'D-1': '0001110', 'A-1': '0110010', 'M-1': '1110010', 'D+A': '0000010', 'D+M': '1000010',
-                             'D-A': '0010011', 'D-M': '1010011', 'A-D': '0000111', 'M-D': '1000111', 'D&A': '0000000',
-                             'D&M': '1000000', 'D|A': '0010101', 'D|M': '1010101'}
-        self.__dest_table = {'null': '000', 'M': '001', 'D': '010', 'DM': '011', 'MD': '011', 'A': '100', 'AM': '101',
-                             'AD': '110', 'ADM': '111'}
-        self.__jump_table = {'null': '000', 'JGT': '001', 'JEQ': '010', 'JGE': '011', 'JLT': '100', 'JNE': '101',
-                             'JLE': '110', 'JMP': '111'}
+        self.__cache = {}
+
+    # Returns the 16-bit word of the C-instruction dest=comp;jump
+    def encode(self, dest, comp, jump):
+        key = (dest, comp, jump)
+        word = self.__cache.get(key)
+        if word is None:
+            word = (0b111 << 13 | self.lookup(self.COMP_TABLE, 'comp', comp) << 6 |
+                    self.lookup(self.DEST_TABLE, 'dest', dest) << 3 | self.lookup(self.JUMP_TABLE, 'jump', jump))
+            self.__cache[key] = word
+        return word
+
+    def lookup(self, table, field, mnemonic):
+        if mnemonic not in table:
+            raise ValueError(f"unknown {field} mnemonic {mnemonic!r} in '{self.current_string}'")
+        return table[mnemonic]
 
     def dest(self, string):
-        return self.__dest_table[string] if string in self.__dest_table else self.__dest_table['null']
+        return format(self.lookup(self.DEST_TABLE, 'dest', string), '03b')
 
     def comp(self, string):
-        return self.__comp_table[string] if string in self.__comp_table else self.__comp_table['null']
+        return format(self.lookup(self.COMP_TABLE, 'comp', string), '07b')
 
     def jump(self, string):
-        return self.__jump_table[string] if string in self.__jump_table else self.__jump_table['null']
+        return format(self.lookup(self.JUMP_TABLE, 'jump', string), '03b')
 
 
 class SymbolTable:
@@ -182,11 +424,205 @@ class SymbolTable:
         return self.symbol_table[symbol]
 
 
-if __name__ == '__main__':
-    files = ['Add', 'MaxL', 'Max', 'RectL', 'Rect', 'PongL', 'Pong']
+# On-disk cache of assembled outputs, keyed by a hash of the source, the output format and ASSEMBLER_VERSION
+# Entries are plain files; hits refresh their mtime and evict() drops the least recently used ones over max_bytes
+class AssemblyCache:
+    def __init__(self, directory, max_bytes=64 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, source_path, output_format):
+        digest = hashlib.sha256(f'{ASSEMBLER_VERSION}\0{output_format}\0'.encode())
+        with open(source_path, 'rb') as file:
+            for chunk in iter(lambda: file.read(1 << 16), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    # Copies the cached output for key to output_path, returning False on a miss
+    def fetch(self, key, output_path):
+        entry = os.path.join(self.directory, key)
+        try:
+            shutil.copyfile(entry, output_path)
+        except FileNotFoundError:
+            return False
+        os.utime(entry)
+        return True
+
+    def store(self, key, output_path):
+        entry = os.path.join(self.directory, key)
+        temp = f'{entry}.{os.getpid()}.tmp'
+        shutil.copyfile(output_path, temp)
+        os.replace(temp, entry)
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+# Resolves ROM addresses of a program through its source maps: to the .asm line, and for translated VM code on to
+# the VM file, line and function. For a .asm program, the ROM-to-.asm map is rebuilt by assembling it in memory
+# Lookups are a list index for the .asm line and a binary search over the ranges for the VM source
+class SourceMap:
+    def __init__(self, program_path):
+        base, extension = os.path.splitext(program_path)
+        if extension == '.asm':
+            assembler = HackAssembler(base, output_format=None, source_map=True)
+            assembler.initialize()
+            assembler.first_pass()
+            assembler.second_pass()
+            self.asm_lines = assembler.rom_lines
+        else:
+            self.asm_lines = self.read(program_path + '.map')['asm_lines']
+
+        self.files = []
+        self.functions = []
+        self.range_starts = []
+        self.ranges = []
+        if os.path.exists(base + '.asm.map'):
+            vm_map = self.read(base + '.asm.map')
+            self.files = vm_map['files']
+            self.functions = vm_map['functions']
+            self.ranges = vm_map['ranges']
+            self.range_starts = [start for start, _, _, _ in self.ranges]
+
+    @staticmethod
+    def read(path):
+        with open(path, 'r', encoding="utf-8") as file:
+            source_map = json.load(file)
+        if source_map.get('version') != SOURCE_MAP_VERSION:
+            raise ValueError(f'{path}: unsupported source map version {source_map.get("version")}')
+        return source_map
+
+    # Returns the .asm line number of ROM[address], or None
+    def asm_line(self, address):
+        return self.asm_lines[address] if 0 <= address < len(self.asm_lines) else None
+
+    # Returns (VM file, VM line, function) for ROM[address], with None for whatever is unknown, or None when the
+    # address does not come from a VM command (such as the bootstrap and the shared routines)
+    def vm_source(self, address):
+        asm_line = self.asm_line(address)
+        position = bisect.bisect_right(self.range_starts, asm_line) - 1 if asm_line is not None else -1
+        if position < 0:
+            return None
+        _, file, vm_line, function = self.ranges[position]
+        if file < 0:
+            return None
+        return self.files[file], vm_line, self.functions[function] if function >= 0 else None
+
+
+def default_cache_dir():
+    return os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser(os.path.join('~', '.cache')),
+                        'hack-assembler')
+
+
+# Assembles one prog.asm and returns (path, error message, cache hit), with None as the message on success
+# Module-level so that it can be shipped to pool workers
+def assemble_file(path, streaming=False, output_format='hack', cache_dir=None, source_map=False):
+    try:
+        file = os.path.splitext(path)[0]
+        output_path = file + '.' + output_format
+        cache = key = None
+        # The cache only holds the assembled output, so a source map means assembling again
+        if cache_dir is not None and not source_map:
+            cache = AssemblyCache(cache_dir)
+            key = cache.key(path, output_format)
+            if cache.fetch(key, output_path):
+                return path, None, True
+
+        assembler = HackAssembler(file, streaming, output_format, source_map)
+        assembler.initialize()
+        assembler.first_pass()
+        assembler.second_pass()
+
+        if cache is not None:
+            cache.store(key, output_path)
+    except Exception as error:
+        return path, f'{type(error).__name__}: {error}', False
+    return path, None, False
+
+
+# Expands the given files and directories into a sorted list of .asm files, searching directories recursively
+def collect_sources(paths):
+    sources = set()
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                sources.update(os.path.join(root, file) for file in files if file.endswith('.asm'))
+        else:
+            sources.add(path)
+    return sorted(sources)
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description='Assembles Hack .asm programs into .hack files.')
+    arg_parser.add_argument('paths', nargs='+', help='.asm files or directories containing them')
+    arg_parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                            help='number of worker processes (default: one per core)')
+    arg_parser.add_argument('--stream', action='store_true', help='assemble with bounded memory')
+    arg_parser.add_argument('--format', choices=sorted(OUTPUT_WRITERS), default='hack',
+                            help='output format: text .hack (default) or packed .rom image')
+    arg_parser.add_argument('--cache-dir', default=default_cache_dir(),
+                            help='where to keep assembled outputs of unchanged sources (default: %(default)s)')
+    arg_parser.add_argument('--cache-size', type=int, default=64,
+                            help='maximum cache size in MiB before old entries are evicted (default: %(default)s)')
+    arg_parser.add_argument('--no-cache', action='store_true', help='always reassemble every file')
+    arg_parser.add_argument('--source-map', action='store_true',
+                            help='also write the .asm line of each ROM address to a .map file next to the output')
+    args = arg_parser.parse_args(argv)
+
+    sources = collect_sources(args.paths)
+    if not sources:
+        arg_parser.error('no .asm files found')
+
+    cache = None if args.no_cache else AssemblyCache(args.cache_dir, args.cache_size * 1024 * 1024)
+    cache_dir = None if cache is None else cache.directory
+
+    jobs = max(1, min(args.jobs, len(sources)))
+    streaming = [args.stream] * len(sources)
+    output_formats = [args.format] * len(sources)
+    cache_dirs = [cache_dir] * len(sources)
+    source_maps = [args.source_map] * len(sources)
+    if jobs == 1:
+        results = list(map(assemble_file, sources, streaming, output_formats, cache_dirs, source_maps))
+    else:
+        # map() keeps the input order, so the report does not depend on which worker finishes first
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            results = list(pool.map(assemble_file, sources, streaming, output_formats, cache_dirs, source_maps))
+
+    failed = hits = 0
+    for path, error, hit in results:
+        if error is not None:
+            failed += 1
+            print(f'FAILED  {path}: {error}')
+        elif hit:
+            hits += 1
+            print(f'cached  {path}')
+        else:
+            print(f'ok      {path}')
+    print(f'{len(results) - failed} assembled, {failed} failed')
+
+    if cache is not None:
+        cache.evict()
+        print(f'cache: {hits} hits, {len(results) - failed - hits} misses')
+
+    return 1 if failed else 0
 
-    assembler = HackAssembler(files[6])
 
-    assembler.initialize()
-    assembler.first_pass()
-    assembler.second_pass()
+if __name__ == '__main__':
+    sys.exit(main())
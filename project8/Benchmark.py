@@ -0,0 +1,324 @@
+import argparse
+import gc
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from Build import build
+from VMTranslator import CodeWriter, Parser, read_lines
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'project6'))
+from main import HackAssembler  # noqa: E402
+
+# Version of the results JSON, checked when comparing with a baseline
+BENCHMARK_VERSION = 1
+
+
+# Synthetic workloads: each generator returns {file name: lines} for a program of about size VM commands or, for
+# asm, size assembly lines. Every VM workload is a directory program with a Sys.init, so that it builds like the
+# course programs; the programs are only translated and assembled, never run
+
+# A chain of functions, each calling the next one
+def generate_calls(size):
+    count = max(1, size // 6)
+    lines = []
+    for i in range(count):
+        lines += [f'function Chain.f{i} 1',
+                  'push argument 0', 'push constant 1', 'add', 'pop local 0',
+                  'push local 0']
+        lines += [f'call Chain.f{i + 1} 1', 'return'] if i + 1 < count else ['return']
+    return {'Chain.vm': lines, 'Sys.vm': sys_init('push constant 0', 'call Chain.f0 1')}
+
+
+# One long function with a label, a conditional jump and a jump per few commands
+def generate_labels(size):
+    lines = ['function Labels.run 0']
+    for i in range(max(1, size // 5)):
+        lines += [f'label L{i}', f'push constant {i % 2}', f'if-goto L{i + 1}', f'goto L{i + 1}']
+    lines += [f'label L{max(1, size // 5)}', 'push constant 0', 'return']
+    return {'Labels.vm': lines, 'Sys.vm': sys_init('call Labels.run 0')}
+
+
+# Many distinct static variables, each becoming an assembler variable symbol
+def generate_statics(size):
+    lines = ['function Statics.run 0']
+    for i in range(max(1, size // 4)):
+        lines += [f'push constant {i % 32768}', f'pop static {i}', f'push static {i}', 'pop temp 0']
+    lines += ['push constant 0', 'return']
+    return {'Statics.vm': lines, 'Sys.vm': sys_init('call Statics.run 0')}
+
+
+# Counting loops that compare on every iteration
+def generate_compare(size):
+    lines = ['function Compare.run 1']
+    for i in range(max(1, size // 16)):
+        lines += ['push constant 0', 'pop local 0',
+                  f'label LOOP{i}',
+                  'push local 0', f'push constant {i % 100 + 1}', 'lt', 'not', f'if-goto END{i}',
+                  'push local 0', 'push local 0', 'eq', 'pop temp 0',
+                  'push local 0', 'push constant 1', 'add', 'pop local 0', f'goto LOOP{i}',
+                  f'label END{i}']
+    lines += ['push constant 0', 'return']
+    return {'Compare.vm': lines, 'Sys.vm': sys_init('call Compare.run 0')}
+
+
+# Many small files, each with a function calling into the next file
+def generate_files(size):
+    count = max(1, size // 40)
+    files = {}
+    for i in range(count):
+        lines = []
+        for j in range(4):
+            lines += [f'function File{i}.f{j} 0', 'push argument 0', f'push constant {j}', 'add', 'pop static 0',
+                      'push static 0']
+            lines += [f'call File{i + 1}.f{j} 1'] if i + 1 < count else []
+            lines += ['return']
+        files[f'File{i}.vm'] = lines
+    files['Sys.vm'] = sys_init('push constant 0', 'call File0.f0 1')
+    return files
+
+
+def sys_init(*commands):
+    return ['function Sys.init 0', *commands, 'label END', 'goto END']
+
+
+# Assembly with a label every few lines and as many variables as labels
+def generate_asm(size):
+    lines = []
+    for i in range(max(1, size // 8)):
+        lines += [f'(LOOP{i})', f'@var{i}', 'M=M+1', 'D=M', f'@LOOP{i}', 'D;JGT', f'@{i % 32768}', 'D=D+A']
+    lines += ['(END)', '@END', '0;JMP']
+    return {'Asm.asm': lines}
+
+
+WORKLOADS = {'calls': generate_calls, 'labels': generate_labels, 'statics': generate_statics,
+             'compare': generate_compare, 'files': generate_files, 'asm': generate_asm}
+
+
+# Marks a --keep directory as holding workloads written by this tool, so that later runs may replace them
+KEEP_MARKER = '.benchmark-workloads'
+# Files the workloads and their builds are made of
+GENERATED_EXTENSIONS = ('.vm', '.asm', '.hack')
+
+
+# Makes directory ready to hold kept workloads: creates it, or takes it over when it is empty
+# Raises ValueError for a non-empty directory that this tool did not create
+def prepare_keep_dir(directory):
+    marker = os.path.join(directory, KEEP_MARKER)
+    if os.path.isdir(directory) and os.listdir(directory) and not os.path.exists(marker):
+        raise ValueError(f'{directory} is not empty and was not created by Benchmark.py')
+    os.makedirs(directory, exist_ok=True)
+    with open(marker, 'w', encoding="utf-8"):
+        pass
+
+
+# Writes the files of a workload into their own directory and returns the directory
+# Generated files left there by an earlier run with --keep, such as the extra files of a larger size, are removed
+# first so that they do not join the workload; nothing else in the directory is touched
+def write_workload(root, name, files):
+    directory = os.path.join(root, name)
+    os.makedirs(directory, exist_ok=True)
+    for file in os.listdir(directory):
+        path = os.path.join(directory, file)
+        if file.endswith(GENERATED_EXTENSIONS) and os.path.isfile(path):
+            os.remove(path)
+    for file_name, lines in files.items():
+        with open(os.path.join(directory, file_name), 'w', encoding="utf-8") as file:
+            file.write('\n'.join(lines) + '\n')
+    return directory
+
+
+# Stages of the toolchain, each a function of the workload directory that returns the number of lines it handled
+# The assembler stages take the .asm lines of the workload, translated beforehand by prepare_asm
+
+def parse_vm(directory, options):
+    count = 0
+    for file in sorted(os.listdir(directory)):
+        if file.endswith('.vm'):
+            parser = Parser(os.path.join(directory, file))
+            while parser.has_more_lines():
+                parser.advance()
+                count += 1
+    return count
+
+
+def write_code(directory, options):
+    CodeWriter(directory, write_asm=False, **options)
+    return count_vm_lines(directory)
+
+
+def end_to_end(directory, options):
+    build(directory, 'hack', **options)
+    return count_vm_lines(directory)
+
+
+def count_vm_lines(directory):
+    return sum(1 for file in os.listdir(directory) if file.endswith('.vm')
+               for _ in read_lines(os.path.join(directory, file)))
+
+
+# Returns the .asm lines of a workload without comments: the .asm file itself, or the translation of its .vm files
+def prepare_asm(directory, options):
+    asm_files = [file for file in os.listdir(directory) if file.endswith('.asm')]
+    if asm_files:
+        with open(os.path.join(directory, asm_files[0]), 'r', encoding="utf-8") as file:
+            return [line.strip() for line in file if line.strip()]
+    return [line for line in CodeWriter(directory, write_asm=False, **options).res if not line.startswith('//')]
+
+
+# Times first_pass and second_pass separately on the same assembler, as the second depends on the first
+def assemble(lines, directory):
+    assembler = HackAssembler(os.path.join(directory, 'bench'), output_format=None)
+    assembler.initialize(lines)
+    start = time.perf_counter()
+    assembler.first_pass()
+    middle = time.perf_counter()
+    assembler.second_pass()
+    return middle - start, time.perf_counter() - middle
+
+
+# Runs function(*args) with the garbage collector off, as timeit does, so that collections triggered by earlier
+# workloads do not land in the timings. Returns (wall time, result)
+def timed(function, *args):
+    gc.collect()
+    gc.disable()
+    try:
+        start = time.perf_counter()
+        result = function(*args)
+        return time.perf_counter() - start, result
+    finally:
+        gc.enable()
+
+
+# Runs function(*args) repeat times and returns (best wall time, result of the last run)
+def best_time(repeat, function, *args):
+    runs = [timed(function, *args) for _ in range(repeat)]
+    return min(seconds for seconds, _ in runs), runs[-1][1]
+
+
+# Returns the peak traced memory of function(*args) in KiB. tracemalloc slows Python down a lot, so this is a
+# separate run from the timed ones
+def peak_memory(function, *args):
+    tracemalloc.start()
+    try:
+        function(*args)
+        return tracemalloc.get_traced_memory()[1] // 1024
+    finally:
+        tracemalloc.stop()
+
+
+def stage_result(seconds, lines, peak_kib):
+    return {'seconds': round(seconds, 6), 'lines': lines,
+            'lines_per_sec': round(lines / seconds) if seconds else None, 'peak_kib': peak_kib}
+
+
+# Times every stage on one workload directory and returns {stage: result}
+# The two assembler passes share one peak memory figure, measured over both
+def run_workload(directory, options, repeat, memory):
+    results = {}
+    vm = any(file.endswith('.vm') for file in os.listdir(directory))
+    if vm:
+        for stage, function in (('parser', parse_vm), ('code_writer', write_code), ('end_to_end', end_to_end)):
+            seconds, lines = best_time(repeat, function, directory, options)
+            peak = peak_memory(function, directory, options) if memory else None
+            results[stage] = stage_result(seconds, lines, peak)
+
+    lines = prepare_asm(directory, options)
+    passes = [timed(assemble, lines, directory)[1] for _ in range(repeat)]
+    peak = peak_memory(assemble, lines, directory) if memory else None
+    results['first_pass'] = stage_result(min(first for first, _ in passes), len(lines), peak)
+    results['second_pass'] = stage_result(min(second for _, second in passes), len(lines), peak)
+    return results
+
+
+# Compares results with a baseline and returns a description of every stage that got slower than time_threshold
+# times, or used more than memory_threshold times the memory of, its baseline. Stages missing on either side
+# are skipped
+def compare(results, baseline, time_threshold, memory_threshold):
+    if baseline.get('version') != BENCHMARK_VERSION:
+        raise ValueError(f'unsupported baseline version {baseline.get("version")}')
+    if baseline.get('size') != results['size']:
+        raise ValueError(f'baseline workloads have size {baseline.get("size")}, not {results["size"]}')
+    if baseline.get('options') != results['options']:
+        raise ValueError(f'baseline was run with options {baseline.get("options")}, not {results["options"]}')
+
+    regressions = []
+    for workload, stages in results['workloads'].items():
+        for stage, result in stages.items():
+            base = baseline['workloads'].get(workload, {}).get(stage)
+            if base is None:
+                continue
+            if base['seconds'] and result['seconds'] > base['seconds'] * time_threshold:
+                regressions.append(f'{workload}/{stage}: {result["seconds"]:.4f}s, '
+                                   f'{result["seconds"] / base["seconds"]:.2f}x the baseline {base["seconds"]:.4f}s')
+            if base['peak_kib'] and result['peak_kib'] and result['peak_kib'] > base['peak_kib'] * memory_threshold:
+                regressions.append(f'{workload}/{stage}: peak {result["peak_kib"]} KiB, '
+                                   f'{result["peak_kib"] / base["peak_kib"]:.2f}x the baseline {base["peak_kib"]} KiB')
+    return regressions
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description='Times the VM translator and the assembler on synthetic '
+                                                     'programs and compares the results with a baseline.')
+    arg_parser.add_argument('workloads', nargs='*', metavar='WORKLOAD',
+                            help=f'workloads to run, from {", ".join(sorted(WORKLOADS))} (default: all of them)')
+    arg_parser.add_argument('--size', type=int, default=20_000,
+                            help='VM commands (or asm lines) per workload (default: %(default)s)')
+    arg_parser.add_argument('--repeat', type=int, default=3, help='timed runs per stage, best kept (default: 3)')
+    arg_parser.add_argument('--no-memory', action='store_true', help='skip the peak memory runs')
+    arg_parser.add_argument('--option', action='append', default=[], metavar='NAME',
+                            help='enable a CodeWriter option (e.g. optimize), may be repeated')
+    arg_parser.add_argument('--keep', metavar='DIR',
+                            help='generate the workloads in DIR and keep them; DIR must be new, empty or from an '
+                                 'earlier --keep run')
+    arg_parser.add_argument('--output', metavar='PATH', help='write the results as JSON')
+    arg_parser.add_argument('--baseline', metavar='PATH', help='compare with the results in PATH')
+    arg_parser.add_argument('--time-threshold', type=float, default=1.25,
+                            help='slowdown over the baseline that counts as a regression (default: %(default)s)')
+    arg_parser.add_argument('--memory-threshold', type=float, default=1.25,
+                            help='peak memory growth over the baseline that counts as a regression '
+                                 '(default: %(default)s)')
+    args = arg_parser.parse_args(argv)
+    unknown = sorted(set(args.workloads) - set(WORKLOADS))
+    if unknown:
+        arg_parser.error(f'unknown workloads {", ".join(unknown)}')
+
+    if args.keep:
+        try:
+            prepare_keep_dir(args.keep)
+        except ValueError as error:
+            arg_parser.error(str(error))
+
+    options = dict.fromkeys(args.option, True)
+    results = {'version': BENCHMARK_VERSION, 'size': args.size, 'options': sorted(args.option), 'workloads': {}}
+    with tempfile.TemporaryDirectory() as temp_dir:
+        root = args.keep or temp_dir
+        for name in sorted(set(args.workloads or WORKLOADS)):
+            directory = write_workload(root, name, WORKLOADS[name](args.size))
+            stages = run_workload(directory, options, args.repeat, not args.no_memory)
+            results['workloads'][name] = stages
+            for stage, result in stages.items():
+                peak = '' if result['peak_kib'] is None else f'{result["peak_kib"]:>9} KiB'
+                print(f'{name:<8} {stage:<12} {result["lines"]:>8} lines {result["seconds"] * 1000:>10.1f} ms '
+                      f'{result["lines_per_sec"] or 0:>10} lines/s {peak}')
+
+    if args.output:
+        with open(args.output, 'w', encoding="utf-8") as file:
+            json.dump(results, file, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding="utf-8") as file:
+            baseline = json.load(file)
+        regressions = compare(results, baseline, args.time_threshold, args.memory_threshold)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        print(f'{len(regressions)} regressions against {args.baseline}')
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,58 @@
+import argparse
+import os
+import sys
+import time
+
+from VMTranslator import CodeWriter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'project6'))
+from main import OUTPUT_WRITERS, HackAssembler, read_numbered_lines  # noqa: E402
+
+
+# Builds a .vm file or a directory of .vm files into Hack machine code in one process: the lines CodeWriter
+# generates go straight to the assembler, without writing and re-reading the .asm text, and comment lines are
+# dropped on the way. Writes prog.hack or prog.rom next to where VMTranslator would write prog.asm, or nothing with
+# output_format=None. With write_asm=True the .asm is written as well, for debugging
+# With source_map=True both source maps are written, prog.hack.map and prog.asm.map, with .asm line numbers that
+# match the .asm file whether or not it is written
+# options are CodeWriter keyword arguments, such as optimize. Returns the ROM words
+def build(path, output_format='hack', write_asm=False, source_map=False, **options):
+    writer = CodeWriter(path, write_asm=write_asm, source_map=source_map, **options)
+    if options.get('streaming') and write_asm:
+        # A streamed translation goes straight to the .asm file and keeps no lines, so they are read back from it
+        numbered = list(read_numbered_lines(writer.output_path))
+    else:
+        numbered = [(line_num, line) for line_num, line in enumerate(writer.res, start=1)
+                    if not line.startswith('//')]
+
+    assembler = HackAssembler(os.path.splitext(writer.output_path)[0], output_format=output_format,
+                              source_map=source_map)
+    assembler.initialize([line for _, line in numbered], [line_num for line_num, _ in numbered])
+    assembler.first_pass()
+    assembler.second_pass()
+    return assembler.res
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description='Builds a VM program (.vm file or directory) into a .hack or '
+                                                     '.rom file without the intermediate .asm text.')
+    arg_parser.add_argument('path')
+    arg_parser.add_argument('--format', choices=sorted(OUTPUT_WRITERS), default='hack',
+                            help='output format: text .hack (default) or packed .rom image')
+    arg_parser.add_argument('--asm', action='store_true', help='also write the .asm file')
+    arg_parser.add_argument('--source-map', action='store_true',
+                            help='also write the source maps (.hack.map or .rom.map, and .asm.map)')
+    arg_parser.add_argument('--option', action='append', default=[], metavar='NAME',
+                            help='enable a CodeWriter option (e.g. optimize), may be repeated')
+    args = arg_parser.parse_args(argv)
+
+    start = time.perf_counter()
+    words = build(args.path, args.format, args.asm, args.source_map, **dict.fromkeys(args.option, True))
+    elapsed = time.perf_counter() - start
+
+    print(f'{len(words)} words in {elapsed:.3f}s')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,270 @@
+import argparse
+import os
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from VMEmulator import VMEmulator
+from VMTranslator import VMTranslator
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'project6'))
+from CPUEmulator import CPUEmulator, load_program  # noqa: E402
+
+PROJECTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+DEFAULT_ROOTS = [os.path.join(PROJECTS_DIR, 'project7'), os.path.join(PROJECTS_DIR, 'project8')]
+
+# Named VM emulator variables and the RAM address holding each of them
+VM_POINTERS = {'sp': 0, 'local': 1, 'argument': 2, 'this': 3, 'that': 4}
+
+TOKEN = re.compile(r'[{},;]|[^\s{},;]+')
+COMMENT = re.compile(r'//[^\n]*|/\*.*?\*/', re.DOTALL)
+
+
+# Splits a test script into commands, each a list of words, with ('repeat', n, body) for repeat blocks
+def parse_script(text):
+    tokens = TOKEN.findall(COMMENT.sub(' ', text))
+    commands, _ = parse_commands(tokens, 0)
+    return commands
+
+
+def parse_commands(tokens, position):
+    commands = []
+    command = []
+    while position < len(tokens):
+        token = tokens[position]
+        position += 1
+        if token in (',', ';'):
+            if command:
+                commands.append(command)
+            command = []
+        elif token == '{':
+            body, position = parse_commands(tokens, position)
+            count = int(command[1]) if len(command) > 1 else None
+            commands.append(('repeat', count, body))
+            command = []
+        elif token == '}':
+            break
+        else:
+            command.append(token)
+    if command:
+        commands.append(command)
+    return commands, position
+
+
+# Runs one .tst (CPU emulator) or VME.tst (VM emulator) script the way the course tools do,
+# collecting the output table and comparing it with the compare-to file
+class TestScript:
+    def __init__(self, path):
+        self.path = path
+        self.directory = os.path.dirname(path)
+        self.vm = path.endswith('VME.tst')
+        self.emulator = None
+        self.compare_to = None
+        self.output_list = []
+        self.output = []
+
+    def run(self):
+        with open(self.path, 'r', encoding="utf-8") as file:
+            self.execute(parse_script(file.read()))
+
+    def execute(self, commands):
+        for command in commands:
+            if command[0] == 'repeat':
+                _, count, body = command
+                # A loop of single steps runs as one call, so the emulator can go at full speed
+                if [step[0] for step in body] == ['ticktock']:
+                    self.emulator.run_compiled(count)
+                elif [step[0] for step in body] == ['vmstep']:
+                    self.emulator.run(count)
+                else:
+                    for _ in range(count):
+                        self.execute(body)
+                continue
+
+            name, args = command[0], command[1:]
+            if name == 'load':
+                self.load(args[0] if args else None)
+            elif name == 'compare-to':
+                self.compare_to = os.path.join(self.directory, args[0])
+            elif name == 'output-list':
+                self.output_list = [self.parse_column(arg) for arg in args]
+                self.output.append(self.header())
+            elif name == 'output':
+                self.output.append(self.row())
+            elif name == 'set':
+                self.set(args[0], int(args[1]))
+            elif name == 'ticktock':
+                self.emulator.run(1)
+            elif name == 'vmstep':
+                self.emulator.run(1)
+            elif name not in ('output-file', 'echo', 'clear-echo', 'breakpoint', 'clear-breakpoints', 'tick', 'tock'):
+                raise ValueError(f'{self.path}: unsupported command {name!r}')
+
+    def load(self, name):
+        if self.vm:
+            path = os.path.join(self.directory, name) if name else self.directory
+            self.emulator = VMEmulator(path, bootstrap=False)
+            # The VM emulator starts at Sys.init when the program has one
+            if 'Sys.init' in self.emulator.functions:
+                self.emulator.pc = self.emulator.functions['Sys.init']
+        else:
+            self.emulator = CPUEmulator(load_program(os.path.join(self.directory, name)))
+
+    # Resolves a variable name such as RAM[256], sp, local or argument[1] to a RAM address
+    def address(self, name):
+        match = re.fullmatch(r'(\w+)(?:\[(\d+)])?', name)
+        if not match:
+            raise ValueError(f'{self.path}: unsupported variable {name!r}')
+        variable, index = match.group(1), match.group(2)
+        if variable == 'RAM' and index is not None:
+            return int(index)
+        if self.vm and variable in VM_POINTERS:
+            pointer = VM_POINTERS[variable]
+            return pointer if index is None else self.emulator.ram[pointer] + int(index)
+        if self.vm and variable == 'temp' and index is not None:
+            return 5 + int(index)
+        raise ValueError(f'{self.path}: unsupported variable {name!r}')
+
+    def set(self, name, value):
+        if not self.vm and name in ('A', 'D', 'PC'):
+            setattr(self.emulator, name.lower(), value & 0xFFFF)
+        else:
+            self.emulator.poke(self.address(name), value)
+
+    def value(self, name):
+        if not self.vm and name in ('A', 'D', 'PC'):
+            value = getattr(self.emulator, name.lower())
+            return value - 0x10000 if value & 0x8000 else value
+        return self.emulator.peek(self.address(name))
+
+    # Parses an output-list entry like RAM[0]%D1.6.1 into (name, format, left pad, width, right pad)
+    def parse_column(self, column):
+        name, _, spec = column.partition('%')
+        match = re.fullmatch(r'([BDXS])(\d+)\.(\d+)\.(\d+)', spec or 'D1.6.1')
+        if not match:
+            raise ValueError(f'{self.path}: unsupported output format {column!r}')
+        return name, match.group(1), int(match.group(2)), int(match.group(3)), int(match.group(4))
+
+    def header(self):
+        cells = []
+        for name, _, left, width, right in self.output_list:
+            total = left + width + right
+            name = name[:total]
+            padding = (total - len(name)) // 2
+            cells.append(' ' * padding + name + ' ' * (total - len(name) - padding))
+        return '|' + '|'.join(cells) + '|'
+
+    def row(self):
+        cells = []
+        for name, output_format, left, width, right in self.output_list:
+            value = self.value(name)
+            if output_format == 'B':
+                text = format(value & 0xFFFF, '016b')[-width:]
+            elif output_format == 'X':
+                text = format(value & 0xFFFF, '04X')[-width:]
+            else:
+                text = str(value)
+            cells.append(' ' * left + text.rjust(width) + ' ' * right)
+        return '|' + '|'.join(cells) + '|'
+
+    # Returns None when the output matches the compare-to file, else a description of the first difference
+    def compare(self):
+        if self.compare_to is None:
+            return None
+        with open(self.compare_to, 'r', encoding="utf-8") as file:
+            expected = [line.rstrip('\r\n') for line in file if line.strip()]
+        for line_num, (actual_line, expected_line) in enumerate(zip(self.output, expected), start=1):
+            if actual_line != expected_line:
+                return f'line {line_num}: expected {expected_line!r}, got {actual_line!r}'
+        if len(self.output) != len(expected):
+            return f'expected {len(expected)} output lines, got {len(self.output)}'
+        return None
+
+
+# Translates the VM sources a CPU test script loads, so that the test checks the current translator
+# options are CodeWriter keyword arguments, such as optimize
+def translate_for(test_path, options=()):
+    directory = os.path.dirname(test_path)
+    name = os.path.basename(test_path)[:-len('.tst')]
+    source = os.path.join(directory, name + '.vm')
+    VMTranslator(source if os.path.isfile(source) else directory, **dict.fromkeys(options, True))
+
+
+# Runs one test script and returns (path, error message, wall time, simulated cycles), with None as the
+# message when the output matches. Module-level so that it can be shipped to pool workers
+def run_test(path, translate=False, options=()):
+    start = time.perf_counter()
+    script = TestScript(path)
+    try:
+        if translate and not script.vm:
+            translate_for(path, options)
+        script.run()
+        error = script.compare()
+    except Exception as exception:
+        error = f'{type(exception).__name__}: {exception}'
+    cycles = 0
+    if script.emulator is not None:
+        cycles = script.emulator.steps if script.vm else script.emulator.cycles
+    return path, error, time.perf_counter() - start, cycles
+
+
+def collect_tests(paths, kind):
+    tests = set()
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                tests.update(os.path.join(root, file) for file in files if file.endswith('.tst'))
+        else:
+            tests.add(path)
+    if kind == 'cpu':
+        tests = {test for test in tests if not test.endswith('VME.tst')}
+    elif kind == 'vm':
+        tests = {test for test in tests if test.endswith('VME.tst')}
+    return sorted(tests)
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description='Runs .tst scripts against the Python CPU and VM emulators '
+                                                     'and compares the output with their .cmp files.')
+    arg_parser.add_argument('paths', nargs='*', default=DEFAULT_ROOTS,
+                            help='.tst files or directories containing them (default: project7 and project8)')
+    arg_parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                            help='number of worker processes (default: one per core)')
+    arg_parser.add_argument('--kind', choices=['all', 'cpu', 'vm'], default='all',
+                            help='run only CPU emulator (.tst) or VM emulator (VME.tst) scripts')
+    arg_parser.add_argument('--translate', action='store_true',
+                            help='regenerate the .asm files with VMTranslator before running CPU scripts')
+    arg_parser.add_argument('--option', action='append', default=[], metavar='NAME',
+                            help='enable a CodeWriter option (e.g. optimize) when translating; implies --translate')
+    args = arg_parser.parse_args(argv)
+
+    tests = collect_tests([os.path.abspath(path) for path in args.paths], args.kind)
+    if not tests:
+        arg_parser.error('no test scripts found')
+
+    jobs = max(1, min(args.jobs, len(tests)))
+    translate = [args.translate or bool(args.option)] * len(tests)
+    options = [tuple(args.option)] * len(tests)
+    start = time.perf_counter()
+    if jobs == 1:
+        results = list(map(run_test, tests, translate, options))
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            results = list(pool.map(run_test, tests, translate, options))
+    elapsed = time.perf_counter() - start
+
+    failed = 0
+    for path, error, wall_time, cycles in results:
+        status = 'ok' if error is None else 'FAILED'
+        print(f'{status:<7} {os.path.relpath(path)}  {wall_time * 1000:8.1f} ms  {cycles:>9} cycles')
+        if error is not None:
+            failed += 1
+            print(f'        {error}')
+    print(f'{len(results) - failed} passed, {failed} failed in {elapsed:.2f}s')
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,263 @@
+import argparse
+import os
+import sys
+import time
+from array import array
+
+from VMTranslator import CommandType, Parser
+
+RAM_SIZE = 32768
+STATIC_BASE = 16
+TEMP_BASE = 5
+POINTER_BASE = 3
+
+# Opcodes of the resolved program, one per instruction kind the run loop distinguishes
+(PUSH_CONSTANT, PUSH_SEGMENT, PUSH_ADDRESS, POP_SEGMENT, POP_ADDRESS, ADD, SUB, NEG, EQ, GT, LT, AND, OR, NOT,
+ GOTO, IF_GOTO, FUNCTION, CALL, RETURN, HALT) = range(20)
+
+ARITHMETIC_OPCODES = {'add': ADD, 'sub': SUB, 'neg': NEG, 'eq': EQ, 'gt': GT, 'lt': LT, 'and': AND, 'or': OR,
+                      'not': NOT}
+# Segments addressed through a base pointer, mapped to the RAM address of that pointer
+SEGMENT_POINTERS = {'local': 1, 'argument': 2, 'this': 3, 'that': 4}
+
+
+# Lists the .vm files of a program: the file itself, or the directory's .vm files in sorted order
+def program_files(path):
+    if os.path.isfile(path):
+        return [path]
+    return [os.path.join(path, file) for file in sorted(os.listdir(path)) if file.endswith('.vm')]
+
+
+# Executes VM programs directly, as a reference for the output of VMTranslator
+# Commands are parsed with the translator's Parser and resolved once into (opcode, x, y) tuples:
+# labels and function names become instruction indices, and static/temp/pointer accesses become RAM addresses.
+# The stack, the segments and the saved frames all live in one array of RAM_SIZE unsigned 16-bit words, laid out
+# like the Hack platform, so RAM can be compared with a run of the translated program
+class VMEmulator:
+    def __init__(self, path, bootstrap=None):
+        self.ram = array('H', bytes(2 * RAM_SIZE))
+        self.program = []
+        self.lines = []
+        self.functions = {}
+        self.statics = {}
+        self.pc = 0
+        self.steps = 0
+
+        self.load(program_files(path))
+
+        # Like write_init, a directory with Sys.init starts by setting SP to 256 and calling Sys.init
+        if bootstrap is None:
+            bootstrap = os.path.isdir(path) and 'Sys.init' in self.functions
+        if bootstrap:
+            self.ram[0] = 256
+            self.pc = len(self.program)
+            self.program.append((CALL, self.functions['Sys.init'], 0))
+            self.program.append((HALT, 0, 0))
+            self.lines.append('call Sys.init 0')
+            self.lines.append('')
+
+    def load(self, paths):
+        commands = []
+        for path in paths:
+            file_name = os.path.basename(path).replace('.vm', '')
+            parser = Parser(path)
+            function_name = None
+            while parser.has_more_lines():
+                parser.advance()
+                command = parser.current_command
+                if command.kind == CommandType.C_FUNCTION:
+                    function_name = command.arg1
+                commands.append((file_name, function_name, command.kind, command.arg1, command.arg2, command.line))
+
+        # Labels are scoped to their function, and like in the course VM emulator they take no step:
+        # they are dropped and resolve to the index of the command that follows them
+        labels = {}
+        index = 0
+        for file_name, function_name, command_type, arg1, arg2, line in commands:
+            if command_type == CommandType.C_LABEL:
+                labels[function_name, arg1] = index
+            else:
+                if command_type == CommandType.C_FUNCTION:
+                    self.functions[arg1] = index
+                index += 1
+        commands = [command for command in commands if command[2] != CommandType.C_LABEL]
+
+        self.program = [self.resolve(command, labels) for command in commands]
+        self.lines = [command[-1] for command in commands]
+        self.program.append((HALT, 0, 0))
+        self.lines.append('')
+
+    def resolve(self, command, labels):
+        file_name, function_name, command_type, arg1, arg2, line = command
+
+        if command_type == CommandType.C_ARITHMETIC:
+            if arg1 not in ARITHMETIC_OPCODES:
+                raise ValueError(f"unknown command '{line}'")
+            return ARITHMETIC_OPCODES[arg1], 0, 0
+
+        if command_type in (CommandType.C_PUSH, CommandType.C_POP):
+            index = arg2
+            push = command_type == CommandType.C_PUSH
+            if arg1 == 'constant' and push:
+                return PUSH_CONSTANT, index, 0
+            if arg1 in SEGMENT_POINTERS:
+                return PUSH_SEGMENT if push else POP_SEGMENT, SEGMENT_POINTERS[arg1], index
+            if arg1 == 'temp':
+                address = TEMP_BASE + index
+            elif arg1 == 'pointer':
+                address = POINTER_BASE + index
+            elif arg1 == 'static':
+                # Statics get addresses from 16 up in order of first use, as the assembler allocates variables
+                address = self.statics.setdefault(f'{file_name}.{index}', STATIC_BASE + len(self.statics))
+            else:
+                raise ValueError(f"unknown segment in '{line}'")
+            return PUSH_ADDRESS if push else POP_ADDRESS, address, 0
+
+        if command_type in (CommandType.C_GOTO, CommandType.C_IF):
+            if (function_name, arg1) not in labels:
+                raise ValueError(f"undefined label in '{line}'")
+            return GOTO if command_type == CommandType.C_GOTO else IF_GOTO, labels[function_name, arg1], 0
+
+        if command_type == CommandType.C_FUNCTION:
+            return FUNCTION, arg2, 0
+        if command_type == CommandType.C_CALL:
+            if arg1 not in self.functions:
+                raise ValueError(f"undefined function in '{line}'")
+            return CALL, self.functions[arg1], arg2
+        return RETURN, 0, 0
+
+    # Returns RAM[address] as a signed 16-bit value
+    def peek(self, address):
+        value = self.ram[address]
+        return value - 0x10000 if value & 0x8000 else value
+
+    # Stores a (possibly negative) value in RAM[address]
+    def poke(self, address, value):
+        self.ram[address] = value & 0xFFFF
+
+    # Executes up to max_steps VM commands, stopping early at the end of the program
+    # Saved return addresses are instruction indices rather than ROM addresses; everything else in RAM matches
+    # the translated program. Returns the number of commands executed
+    def run(self, max_steps):
+        ram = self.ram
+        program = self.program
+        pc = self.pc
+        sp = ram[0]
+        executed = 0
+
+        try:
+            while executed < max_steps:
+                op, x, y = program[pc]
+                if op == HALT:
+                    break
+                executed += 1
+                pc += 1
+
+                if op == PUSH_CONSTANT:
+                    ram[sp] = x
+                    sp += 1
+                elif op == PUSH_SEGMENT:
+                    ram[sp] = ram[ram[x] + y]
+                    sp += 1
+                elif op == PUSH_ADDRESS:
+                    ram[sp] = ram[x]
+                    sp += 1
+                elif op == POP_SEGMENT:
+                    sp -= 1
+                    ram[ram[x] + y] = ram[sp]
+                elif op == POP_ADDRESS:
+                    sp -= 1
+                    ram[x] = ram[sp]
+                elif op <= OR:
+                    if op == NEG:
+                        ram[sp - 1] = -ram[sp - 1] & 0xFFFF
+                        continue
+                    sp -= 1
+                    a = ram[sp - 1]
+                    b = ram[sp]
+                    if op == ADD:
+                        ram[sp - 1] = (a + b) & 0xFFFF
+                    elif op == SUB:
+                        ram[sp - 1] = (a - b) & 0xFFFF
+                    elif op == AND:
+                        ram[sp - 1] = a & b
+                    elif op == OR:
+                        ram[sp - 1] = a | b
+                    elif op == EQ:
+                        ram[sp - 1] = 0xFFFF if a == b else 0
+                    # Flipping the sign bit turns a signed comparison into an unsigned one
+                    elif op == GT:
+                        ram[sp - 1] = 0xFFFF if a ^ 0x8000 > b ^ 0x8000 else 0
+                    else:
+                        ram[sp - 1] = 0xFFFF if a ^ 0x8000 < b ^ 0x8000 else 0
+                elif op == NOT:
+                    ram[sp - 1] = ~ram[sp - 1] & 0xFFFF
+                elif op == GOTO:
+                    pc = x
+                elif op == IF_GOTO:
+                    sp -= 1
+                    if ram[sp]:
+                        pc = x
+                elif op == FUNCTION:
+                    for _ in range(x):
+                        ram[sp] = 0
+                        sp += 1
+                elif op == CALL:
+                    ram[sp] = pc
+                    ram[sp + 1] = ram[1]
+                    ram[sp + 2] = ram[2]
+                    ram[sp + 3] = ram[3]
+                    ram[sp + 4] = ram[4]
+                    sp += 5
+                    ram[2] = sp - 5 - y
+                    ram[1] = sp
+                    pc = x
+                else:
+                    frame = ram[1]
+                    pc = ram[frame - 5]
+                    arg = ram[2]
+                    ram[arg] = ram[sp - 1]
+                    sp = arg + 1
+                    ram[4] = ram[frame - 1]
+                    ram[3] = ram[frame - 2]
+                    ram[2] = ram[frame - 3]
+                    ram[1] = ram[frame - 4]
+                # SP stays in RAM[0] for programs that read it through a segment
+                ram[0] = sp
+        except IndexError:
+            raise RuntimeError(f"'{self.lines[pc - 1]}': memory access out of range") from None
+        finally:
+            ram[0] = sp
+            self.pc = pc
+            self.steps += executed
+
+        return executed
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description='Runs a VM program (.vm file or directory) directly.')
+    arg_parser.add_argument('path')
+    arg_parser.add_argument('-n', '--steps', type=int, default=1_000_000, help='step limit (default: %(default)s)')
+    arg_parser.add_argument('--set', nargs=2, type=int, action='append', default=[], metavar=('ADDRESS', 'VALUE'),
+                            help='initial RAM value, may be repeated')
+    arg_parser.add_argument('--no-bootstrap', action='store_true', help='do not call Sys.init first')
+    arg_parser.add_argument('--dump', type=int, nargs='*', default=list(range(16)), metavar='ADDRESS',
+                            help='RAM addresses printed after the run (default: R0-R15)')
+    args = arg_parser.parse_args(argv)
+
+    emulator = VMEmulator(args.path, bootstrap=False if args.no_bootstrap else None)
+    for address, value in args.set:
+        emulator.poke(address, value)
+
+    start = time.perf_counter()
+    executed = emulator.run(args.steps)
+    elapsed = time.perf_counter() - start
+
+    for address in args.dump:
+        print(f'RAM[{address}] = {emulator.peek(address)}')
+    print(f'{executed} steps in {elapsed:.3f}s ({executed / elapsed / 1e6 if elapsed else 0:.2f}M steps/s)')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
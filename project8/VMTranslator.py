@@ -1,13 +1,17 @@
+import argparse
+import copy
+import json
 import os
-import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from enum import Enum
 
 
 # fileName.vm -> fileName.asm
 # Drives the process
 class VMTranslator:
-    def __init__(self, path):
-        self.code_writer = CodeWriter(path)
+    def __init__(self, path, **options):
+        self.code_writer = CodeWriter(path, **options)
 
 
 class CommandType(Enum):
@@ -23,157 +27,750 @@ class CommandType(Enum):
     C_CALL = 9
 
 
+# The first word of every command that is not an arithmetic-logical command, mapped to its type
+COMMAND_TYPES = {'push': CommandType.C_PUSH, 'pop': CommandType.C_POP, 'label': CommandType.C_LABEL,
+                 'goto': CommandType.C_GOTO, 'if-goto': CommandType.C_IF, 'function': CommandType.C_FUNCTION,
+                 'return': CommandType.C_RETURN, 'call': CommandType.C_CALL}
+COMMAND_NAMES = {kind: name for name, kind in COMMAND_TYPES.items()}
+
+
+# One pre-parsed VM command. Parser.tokenize builds it once per source line, and the translator, its passes and
+# VMEmulator read the fields instead of re-splitting the text
+# arg1 is the command itself for C_ARITHMETIC (add, sub, etc.) and None for C_RETURN; arg2 is the int index, nVars
+# or nArgs of C_PUSH, C_POP, C_FUNCTION and C_CALL, and None otherwise. line_num is the 1-based line in the .vm
+# file, which commands made up by the passes take over from the command they replace
+class Command:
+    __slots__ = ('kind', 'arg1', 'arg2', 'line', 'line_num')
+
+    def __init__(self, kind, arg1=None, arg2=None, line='', line_num=None):
+        self.kind = kind
+        self.arg1 = arg1
+        self.arg2 = arg2
+        self.line = line
+        self.line_num = line_num
+
+    def __repr__(self):
+        return f'Command({self.kind.name}, {self.arg1!r}, {self.arg2!r})'
+
+
+# Yields (1-based line number, stripped line) for the command lines of a .vm file, dropping comment lines and
+# blank lines
+def read_lines(path):
+    with open(path, 'r', encoding="utf-8") as file:
+        for line_num, line in enumerate(file, start=1):
+            line = line.strip()
+            if line and not line.startswith('//'):
+                yield line_num, line
+
+
 # Parses each VM command into its lexical elements
 class Parser:
     # Opens the input file/stream, and gets ready to parse it
     def __init__(self, path):
         self.current_line = ''
+        self.current_command = None
         self.line_num = -1
-        self.lines = []
+        self.commands = [self.tokenize(line, line_num) for line_num, line in read_lines(path)]
 
-        with open(path, 'r', encoding="utf-8") as file:
-            lines_temp = file.readlines()
+        # print('commands', self.commands, len(self.commands))
 
-        for line in lines_temp:
-            if not line.strip().startswith('//') and line.strip():
-                self.lines.append(line.strip())
+        self.lines_num = len(self.commands)
 
-        # print('lines', self.lines, len(self.lines))
-
-        self.lines_num = len(self.lines)
+    # Passes the commands through a rewriting pass, a function from commands to commands, before parsing starts
+    def rewrite(self, rewriting_pass):
+        self.commands = list(rewriting_pass(self.commands))
+        self.lines_num = len(self.commands)
 
     def has_more_lines(self) -> bool:
         return self.line_num < self.lines_num - 1
 
     def advance(self):
         self.line_num += 1
-        self.current_line = self.lines[self.line_num]
+        self.current_command = self.commands[self.line_num]
+        self.current_line = self.current_command.line
+
+    # Returns the command offset commands ahead of the current one without advancing, or None past the end
+    def peek(self, offset=1):
+        line_num = self.line_num + offset
+        return self.commands[line_num] if line_num < self.lines_num else None
+
+    # Splits a stripped source line into a Command in a single pass, ignoring a trailing // comment
+    @staticmethod
+    def tokenize(line, line_num=None):
+        words = line.split('//', 1)[0].split()
+        kind = COMMAND_TYPES.get(words[0], CommandType.C_ARITHMETIC)
+        if kind == CommandType.C_ARITHMETIC:
+            return Command(kind, words[0], None, line, line_num)
+        return Command(kind, words[1] if len(words) > 1 else None, int(words[2]) if len(words) > 2 else None, line,
+                       line_num)
 
     # Returns a constant representing the type of the current command
     # If the current command is an arithmetic-logical command, returns C_ARITHMETIC
     def command_type(self):
-        if self.current_line.startswith('push '):
-            return CommandType.C_PUSH
-        if self.current_line.startswith('pop '):
-            return CommandType.C_POP
-        if self.current_line.startswith('label '):
-            return CommandType.C_LABEL
-        if self.current_line.startswith('goto '):
-            return CommandType.C_GOTO
-        if self.current_line.startswith('if-goto '):
-            return CommandType.C_IF
-        if self.current_line.startswith('call '):
-            return CommandType.C_CALL
-        if self.current_line.startswith('function '):
-            return CommandType.C_FUNCTION
-        if self.current_line.startswith('return'):
-            return CommandType.C_RETURN
-        return CommandType.C_ARITHMETIC
+        return self.current_command.kind
 
     # Returns the first argument of the current command
     # In the case of C_ARITHMETIC, the command itself (add, sub, etc.) is returned
     # Should not be called if the current command is C_RETURN
     def arg1(self):
-        if self.command_type() == CommandType.C_ARITHMETIC:
-            return self.current_line.split()[0]
-        return self.current_line.split()[1]
+        return self.current_command.arg1
 
-    # Returns the second argument of the current command
+    # Returns the second argument of the current command, as an int
     # Should be called only if the current command is C_PUSH, C_POP, C_FUNCTION, or C_CALL
     def arg2(self):
-        return self.current_line.split()[2]
+        return self.current_command.arg2
+
+
+# Parser that reads the .vm file lazily instead of holding every command in memory
+# Only the commands that peek has looked ahead at are buffered, and rewriting passes run lazily too
+class StreamingParser(Parser):
+    def __init__(self, path):
+        self.current_line = ''
+        self.current_command = None
+        self.line_num = -1
+        self.commands_iter = (self.tokenize(line, line_num) for line_num, line in read_lines(path))
+        self.ahead = deque()
+
+    def rewrite(self, rewriting_pass):
+        self.commands_iter = rewriting_pass(self.commands_iter)
+
+    # Reads commands until count of them are buffered. Returns False when the file ends first
+    def fill(self, count):
+        while len(self.ahead) < count:
+            command = next(self.commands_iter, None)
+            if command is None:
+                return False
+            self.ahead.append(command)
+        return True
+
+    def has_more_lines(self) -> bool:
+        return self.fill(1)
+
+    def advance(self):
+        self.fill(1)
+        self.line_num += 1
+        self.current_command = self.ahead.popleft()
+        self.current_line = self.current_command.line
+
+    def peek(self, offset=1):
+        return self.ahead[offset - 1] if self.fill(offset) else None
+
+
+# Marks where the assembly lines that follow it come from, in the output of generate_file with source_map=True or
+# cost_report=True. file is None for lines that no VM command produced, such as the shared routines
+class SourceLocation:
+    __slots__ = ('file', 'line_num', 'function', 'command')
+
+    def __init__(self, file=None, line_num=None, function=None, command=None):
+        self.file = file
+        self.line_num = line_num
+        self.function = function
+        self.command = command
+
+
+# Version of the .asm.map source maps, in the format SourceMap in project6/main.py reads
+SOURCE_MAP_VERSION = 1
+
+# How many values each command leaves on the stack minus how many it takes, for the inlining checks
+# Arithmetic-logical commands are keyed by name, the others by type
+STACK_EFFECTS = {CommandType.C_PUSH: 1, CommandType.C_POP: -1, CommandType.C_GOTO: 0, CommandType.C_IF: -1,
+                 'add': -1, 'sub': -1, 'and': -1, 'or': -1, 'eq': -1, 'gt': -1, 'lt': -1, 'neg': 0, 'not': 0}
+
+# 16-bit results of the arithmetic-logical commands on constant operands, for the folding pass
+# Comparisons are signed, so the operands are shifted by 0x8000 to compare them as unsigned numbers
+FOLD_UNARY = {'neg': lambda x: -x & 0xFFFF, 'not': lambda x: ~x & 0xFFFF}
+FOLD_BINARY = {'add': lambda x, y: (x + y) & 0xFFFF,
+               'sub': lambda x, y: (x - y) & 0xFFFF,
+               'and': lambda x, y: x & y,
+               'or': lambda x, y: x | y,
+               'eq': lambda x, y: 0xFFFF if x == y else 0,
+               'gt': lambda x, y: 0xFFFF if x ^ 0x8000 > y ^ 0x8000 else 0,
+               'lt': lambda x, y: 0xFFFF if x ^ 0x8000 < y ^ 0x8000 else 0}
+# Constants y for which "push constant y" followed by the command leaves the stack unchanged
+FOLD_IDENTITIES = {'add': 0, 'sub': 0, 'or': 0, 'and': 0xFFFF}
+
+# Largest function body, in VM commands, that inline=True substitutes at call sites by default
+INLINE_THRESHOLD = 10
+
+
+# Counts the ROM words of assembly lines, leaving out comments and labels
+def rom_size(lines):
+    return sum(1 for line in lines if not line.startswith('//') and not line.startswith('('))
+
+
+# Estimates the Hack instructions executed by one run through lines, from the top or from the label start
+# Conditional jumps are taken to fall through, and jumps to labels among the lines are followed. A jump to any
+# other label is taken to come back, like a call of a shared routine, and the run goes on after it; a jump to an
+# address computed at run time ends the run. Returns (cycles, labels jumped to outside the lines)
+def path_cycles(lines, start=None):
+    labels = {line[1:-1]: position for position, line in enumerate(lines) if line.startswith('(')}
+    position = labels[start] if start is not None else 0
+    visited = set()
+    target = None  # label in A, None when A holds a computed value
+    cycles = 0
+    exits = []
+    while position < len(lines) and position not in visited:
+        visited.add(position)
+        line = lines[position]
+        position += 1
+        if line.startswith('//') or line.startswith('('):
+            continue
+        cycles += 1
+        if line.startswith('@'):
+            target = line[1:]
+            continue
+        if line.endswith(';JMP'):
+            if target is None:
+                break
+            if target in labels:
+                position = labels[target]
+            else:
+                exits.append(target)
+        if 'A' in line.split('=', 1)[0] and '=' in line:
+            target = None
+    return cycles, exits
+
+
+# ROM words and estimated cycles of the generated code by command, function and file, for cost_report=True
+# The commands are named by command_name. A command costs the instructions of one run through its code (see
+# path_cycles) plus those of the shared routines it jumps to; a pair fused by optimize=True counts as its first
+# command, and lines that no command produced, such as the bootstrap and the shared routines, count as runtime
+class CostReport:
+    def __init__(self):
+        self.commands = {}
+        self.functions = {}
+        self.files = {}
+        self.runtime_words = 0
+        # (command, function, file, label) of every jump out of the code of a command, resolved by summary
+        self.exits = []
+
+    @staticmethod
+    def command_name(command):
+        if command.kind == CommandType.C_ARITHMETIC:
+            return command.arg1
+        if command.kind in (CommandType.C_PUSH, CommandType.C_POP):
+            return f'{COMMAND_NAMES[command.kind]} {command.arg1}'
+        return COMMAND_NAMES[command.kind]
+
+    # Adds the lines generated at location, None for the lines before the first location
+    def add(self, location, lines):
+        words = rom_size(lines)
+        if location is None or location.file is None:
+            self.runtime_words += words
+            return
+
+        cycles, exits = path_cycles(lines)
+        keys = (self.command_name(location.command), location.function or '', location.file + '.vm')
+        for table, key in zip((self.commands, self.functions, self.files), keys):
+            entry = table.setdefault(key, {'count': 0, 'words': 0, 'cycles': 0})
+            entry['count'] += 1
+            entry['words'] += words
+            entry['cycles'] += cycles
+        self.exits.extend(keys + (label,) for label in exits)
+
+    # Returns the report as a JSON-ready dict, given the lines of the shared routines and the ROM size
+    def summary(self, routines, rom_words):
+        # The entry labels of the routines, leaving out their inner labels such as VM$EQ.TRUE
+        routine_cycles = {line[1:-1]: path_cycles(routines, line[1:-1])[0]
+                          for line in routines if line.startswith('(') and '.' not in line}
+        for *keys, label in self.exits:
+            if label in routine_cycles:
+                for table, key in zip((self.commands, self.functions, self.files), keys):
+                    table[key]['cycles'] += routine_cycles[label]
+
+        for entry in self.commands.values():
+            entry['cycles_each'] = round(entry['cycles'] / entry['count'], 2)
+        return {'version': COST_REPORT_VERSION,
+                'rom_words': rom_words,
+                'rom_limit': ROM_LIMIT,
+                'fits': rom_words <= ROM_LIMIT,
+                'runtime_words': self.runtime_words,
+                'routine_cycles': routine_cycles,
+                'commands': self.commands,
+                'functions': self.functions,
+                'files': self.files}
+
+
+# Version of the cost report JSON, and the words in the Hack ROM
+COST_REPORT_VERSION = 1
+ROM_LIMIT = 32768
+
+
+# Translates one .vm file of a directory with a copy of writer, so that files can be translated in any order or in
+# worker processes. Returns the assembly lines with what the file adds to the program: whether it uses the shared
+# call routines, the shared comparisons it uses and the ROM words the shared routines save in it
+def translate_file_job(writer, path):
+    writer = copy.copy(writer)
+    writer.uses_shared_calls = False
+    writer.used_compares = set()
+    writer.rom_words_saved = 0
+    lines = writer.translate_file(path)
+    return lines, writer.uses_shared_calls, writer.used_compares, writer.rom_words_saved
 
 
 # Writes the assembly code that implements the parsed command
 class CodeWriter:
+    ram_map = {'local': 'LCL', 'argument': 'ARG', 'this': 'THIS', 'that': 'THAT'}
+
     # Opens an output file / stream and gets ready to write into it
-    def __init__(self, path):
+    # With optimize=True, short windows of VM commands are translated together into fused templates (see write_fused)
+    # With shared_calls=True, call and return jump to one shared routine each instead of inlining the frame handling
+    # With shared_compare=True, eq/gt/lt call one shared routine per comparison kind
+    # With cache_top=True, the top of the stack stays in D between commands (see write_cached)
+    # With prune=True, a directory's functions that Sys.init can never reach are left out (see live_functions_of)
+    # With inline=True, calls to small leaf functions are replaced by the function body (see find_inline_functions)
+    # With fold=True, constant subexpressions are evaluated before translation (see fold_constants)
+    # With jobs > 1, the files of a directory are translated in parallel by that many worker processes
+    # With streaming=True, each file is read lazily and every line is written out as soon as it is generated, so
+    # memory does not grow with the program; the files are then translated one after another (see stream)
+    # With write_asm=False, no .asm file is written and the lines are only kept in res (see Build.build)
+    # With source_map=True, the VM file, line and function of every range of .asm lines go to prog.asm.map
+    # With cost_report=True, the ROM words and estimated cycles of the code are added up in costs (see cost_summary)
+    def __init__(self, path, optimize=False, shared_calls=False, shared_compare=False, cache_top=False,
+                 prune=False, inline=False, inline_threshold=INLINE_THRESHOLD, fold=False, jobs=1, streaming=False,
+                 write_asm=True, source_map=False, cost_report=False):
         self.file = None
+        self.streaming = streaming
+        self.source_map = source_map
+        self.costs = CostReport() if cost_report else None
+        # Whether generate_file marks the lines of each command with a SourceLocation
+        self.locations = source_map or cost_report
+        # (first .asm line, SourceLocation) of each range of lines generated for one VM command
+        self.source_ranges = []
+        self.optimize = optimize
+        self.shared_calls = shared_calls
+        self.shared_compare = shared_compare
+        self.cache_top = cache_top
+        self.top_in_d = False
+        self.uses_shared_calls = False
+        self.used_compares = set()
+        # Functions to translate, None for all of them, and the functions prune left out
+        self.live_functions = None
+        self.removed_functions = []
+        self.inline_threshold = inline_threshold
+        self.inline_functions = {}
+        self.free_temps = []
+        self.inline_count = 0
+        self.fold = fold
+        # ROM words the shared routines saved compared with inlining every call, return and comparison
+        self.rom_words_saved = 0
+        self.rom_size = 0
         res = []
 
         self.jump_count = -1
-        self.call_count = {}
+        self.call_count = 0
 
         # print('  input_path', path)
 
         if os.path.isfile(path):
             file_name = path.split('.')[-2] + '.asm'
+            paths = [path]
+        else:
+            file_name = os.path.join(path, path.split('/')[-1] + '.asm')
 
-            parser = Parser(path)
-            self.parser = parser
-            short_name = os.path.basename(path).replace('.vm', '')
-            self.set_file_name(short_name)
+            vm_files = sorted(f for f in os.listdir(path) if f.endswith('.vm'))
+            # print('vm_files', vm_files)
+            paths = [os.path.join(path, file) for file in vm_files]
 
-            parser.line_num = -1
+        if inline:
+            self.find_inline_functions(paths)
+        if prune and not os.path.isfile(path):
+            self.live_functions, self.removed_functions = self.live_functions_of(paths)
 
-            while parser.has_more_lines():
-                parser.advance()
-                self.current_string = parser.current_line
-
-                if self.parser.command_type() == CommandType.C_ARITHMETIC:
-                    res.extend(self.write_arithmetic())
-                elif self.parser.command_type() == CommandType.C_PUSH or self.parser.command_type() == CommandType.C_POP:
-                    res.extend(self.write_push_pop())
-                elif self.parser.command_type() == CommandType.C_LABEL:
-                    res.extend(self.write_label())
-                elif self.parser.command_type() == CommandType.C_GOTO:
-                    res.extend(self.write_goto())
-                elif self.parser.command_type() == CommandType.C_IF:
-                    res.extend(self.write_if())
-                elif self.parser.command_type() == CommandType.C_FUNCTION:
-                    res.extend(self.write_function())
-                elif self.parser.command_type() == CommandType.C_RETURN:
-                    res.extend(self.write_return())
-                elif self.parser.command_type() == CommandType.C_CALL:
-                    res.extend(self.write_call())
+        if streaming:
+            res = self.stream(paths, bootstrap=not os.path.isfile(path))
 
+        elif os.path.isfile(path):
+            res.extend(self.translate_file(path))
 
-        else:
-            file_name = os.path.join(path, path.split('/')[-1] + '.asm')
-
-            vm_files = [f for f in os.listdir(path) if f.endswith('.vm')]
-            # print('vm_files', vm_files)
+            # Without a bootstrap, the shared routines go first, behind a jump to the program
+            routines = self.write_shared_routines()
+            if routines:
+                res[:0] = ['@VM$START', '0;JMP'] + routines + ['(VM$START)']
+                self.rom_words_saved -= 2 + rom_size(routines)
 
+        else:
             res.extend(self.write_init())
-
-            for file in vm_files:
-                full_path = os.path.join(path, file)
-                parser = Parser(full_path)
-                self.parser = parser
-                short_name = file.replace('.vm', '')
-                self.set_file_name(short_name)
-
-                parser.line_num = -1
-
-                while parser.has_more_lines():
-                    parser.advance()
-                    self.current_string = parser.current_line
-
-                    if self.parser.command_type() == CommandType.C_ARITHMETIC:
-                        res.extend(self.write_arithmetic())
-                    elif self.parser.command_type() == CommandType.C_PUSH or self.parser.command_type() == CommandType.C_POP:
-                        res.extend(self.write_push_pop())
-                    elif self.parser.command_type() == CommandType.C_LABEL:
-                        res.extend(self.write_label())
-                    elif self.parser.command_type() == CommandType.C_GOTO:
-                        res.extend(self.write_goto())
-                    elif self.parser.command_type() == CommandType.C_IF:
-                        res.extend(self.write_if())
-                    elif self.parser.command_type() == CommandType.C_FUNCTION:
-                        res.extend(self.write_function())
-                    elif self.parser.command_type() == CommandType.C_RETURN:
-                        res.extend(self.write_return())
-                    elif self.parser.command_type() == CommandType.C_CALL:
-                        res.extend(self.write_call())
+            init_end = len(res)
+
+            # Files are translated independently and merged in sorted order after the bootstrap
+            writers = [self] * len(paths)
+            if jobs > 1 and len(paths) > 1:
+                with ProcessPoolExecutor(max_workers=min(jobs, len(paths))) as pool:
+                    results = list(pool.map(translate_file_job, writers, paths))
+            else:
+                results = list(map(translate_file_job, writers, paths))
+
+            for lines, uses_shared_calls, used_compares, rom_words_saved in results:
+                res.extend(lines)
+                self.uses_shared_calls |= uses_shared_calls
+                self.used_compares |= used_compares
+                self.rom_words_saved += rom_words_saved
+
+            # The shared routines follow the bootstrap, which never falls through to them
+            routines = self.write_shared_routines()
+            res[init_end:init_end] = routines
+            self.rom_words_saved -= rom_size(routines)
 
         # print('  output_file_name', file_name)
         # print('  self.file', self.file)
 
         # print('res', res)
 
-        with open(file_name, 'w', encoding="utf-8") as file:
-            for line in res:
-                file.write(line + '\n')
+        self.output_path = file_name
+        if self.locations:
+            res = self.record_locations(res)
+            if not streaming:
+                res = list(res)
+        if write_asm:
+            with open(file_name, 'w', encoding="utf-8") as file:
+                for line in res:
+                    file.write(line + '\n')
+                    self.rom_size += rom_size((line,))
+        else:
+            res = list(res)
+            self.rom_size = rom_size(res)
+        # The generated lines are kept in res too, unless they were streamed to the .asm file
+        self.res = [] if streaming and write_asm else res
+
+        if source_map:
+            self.write_source_map(file_name + '.map')
+
+    # Passes the generated lines through, taking out the SourceLocation markers among them into source_ranges
+    # and adding up the costs of the lines between them
+    def record_locations(self, lines):
+        asm_line = 1
+        location = None
+        location_lines = []
+        for line in lines:
+            if line.__class__ is SourceLocation:
+                self.source_ranges.append((asm_line, line))
+                if self.costs is not None:
+                    self.costs.add(location, location_lines)
+                    location = line
+                    location_lines = []
+            else:
+                asm_line += 1
+                if self.costs is not None:
+                    location_lines.append(line)
+                yield line
+        if self.costs is not None:
+            self.costs.add(location, location_lines)
+
+    # Returns the cost report of the program, for cost_report=True
+    def cost_summary(self):
+        return self.costs.summary(self.write_shared_routines(), self.rom_size)
+
+    # Writes source_ranges as a source map, with the file and function names stored once each
+    def write_source_map(self, path):
+        files = {}
+        functions = {}
+        ranges = []
+        for asm_line, location in self.source_ranges:
+            if location.file is None:
+                ranges.append([asm_line, -1, 0, -1])
+                continue
+            file = files.setdefault(location.file + '.vm', len(files))
+            function = -1 if location.function is None else functions.setdefault(location.function, len(functions))
+            ranges.append([asm_line, file, location.line_num, function])
+
+        with open(path, 'w', encoding="utf-8") as file:
+            json.dump({'version': SOURCE_MAP_VERSION, 'files': list(files), 'functions': list(functions),
+                       'ranges': ranges}, file, separators=(',', ':'))
+
+    # Streaming translation: yields the lines of the program file by file, as they are generated
+    # Whether the shared routines are needed is only known at the end, so they follow the program, behind a jump
+    # past the end of the ROM that stands for the program running off its end
+    def stream(self, paths, bootstrap):
+        if bootstrap:
+            yield from self.write_init()
+        for path in paths:
+            yield from self.generate_file(path)
+
+        routines = self.write_shared_routines()
+        if routines:
+            if self.locations:
+                yield SourceLocation()
+            yield from ['@VM$END', '0;JMP'] + routines + ['(VM$END)']
+            self.rom_words_saved -= 2 + rom_size(routines)
+
+    # Translates every command of one .vm file
+    def translate_file(self, path):
+        return list(self.generate_file(path))
+
+    # Yields the assembly lines of one .vm file
+    def generate_file(self, path):
+        parser = StreamingParser(path) if self.streaming else Parser(path)
+        self.parser = parser
+        short_name = os.path.basename(path).replace('.vm', '')
+        self.set_file_name(short_name)
+        # Generated labels are numbered per file and prefixed with the file name (see new_label), so that the
+        # output of a file does not depend on the files translated before it
+        self.jump_count = -1
+        self.call_count = 0
+        self.inline_count = 0
+
+        if self.inline_functions:
+            parser.rewrite(self.inline_calls)
+        if self.fold:
+            parser.rewrite(self.fold_constants)
+
+        parser.line_num = -1
+        skipping = False
+        function_name = None
+
+        while parser.has_more_lines():
+            parser.advance()
+            self.current_string = parser.current_line
+
+            # The commands of a pruned function run up to the next function command
+            if self.live_functions is not None and parser.command_type() == CommandType.C_FUNCTION:
+                skipping = parser.arg1() not in self.live_functions
+            if skipping:
+                continue
+
+            if parser.command_type() == CommandType.C_FUNCTION:
+                function_name = parser.arg1()
+            if self.locations:
+                yield SourceLocation(short_name, parser.current_command.line_num, function_name,
+                                     parser.current_command)
+
+            if self.cache_top:
+                cached = self.write_cached()
+                if cached is not None:
+                    yield from cached
+                    continue
+                yield from self.flush_top()
+
+            if self.optimize:
+                fused = self.write_fused()
+                if fused:
+                    yield from fused
+                    continue
+
+            yield from self.WRITERS[parser.current_command.kind](self)
+
+        yield from self.flush_top()
+
+    # Whole-program pass over the call graph of the given .vm files, from the bootstrap call to Sys.init
+    # Returns (set of reachable functions, list of the other functions in source order)
+    # Calls that are inlined do not count. Without a Sys.init every function is kept, as nothing is known about
+    # the entry points
+    def live_functions_of(self, paths):
+        calls = {}
+        for path in paths:
+            file_name = os.path.basename(path).replace('.vm', '')
+            parser = StreamingParser(path)
+            # Calls before the first function command of a file belong to no function
+            function_name = None
+            while parser.has_more_lines():
+                parser.advance()
+                if parser.command_type() == CommandType.C_FUNCTION:
+                    function_name = parser.arg1()
+                    calls[function_name] = []
+                elif parser.command_type() == CommandType.C_CALL and function_name is not None:
+                    if not self.can_inline_call(parser.arg1(), parser.arg2(), file_name):
+                        calls[function_name].append(parser.arg1())
+
+        if 'Sys.init' not in calls:
+            return set(calls), []
+
+        live = set()
+        pending = ['Sys.init']
+        while pending:
+            function_name = pending.pop()
+            if function_name in live or function_name not in calls:
+                continue
+            live.add(function_name)
+            pending.extend(calls[function_name])
+        return live, [function_name for function_name in calls if function_name not in live]
+
+    # Whole-program scan of the given .vm files for the functions that can be inlined at their call sites: leaf
+    # functions of at most inline_threshold commands that never fall off their end, whose stack is empty at every
+    # label and jump and holds just the return value at every return
+    # An inlined body keeps its arguments, locals and saved pointers in the temp slots no VM code uses
+    def find_inline_functions(self, paths):
+        functions = {}
+        used_temps = set()
+        for path in paths:
+            file_name = os.path.basename(path).replace('.vm', '')
+            parser = StreamingParser(path)
+            body = None
+            while parser.has_more_lines():
+                parser.advance()
+                command = parser.current_command
+                if command.kind == CommandType.C_FUNCTION:
+                    body = []
+                    functions[command.arg1] = (file_name, command.arg2, body)
+                elif body is not None:
+                    body.append(command)
+                if command.kind in (CommandType.C_PUSH, CommandType.C_POP) and command.arg1 == 'temp':
+                    used_temps.add(command.arg2)
+
+        self.free_temps = [i for i in range(8) if i not in used_temps]
+        self.inline_functions = {function_name: function for function_name, function in functions.items()
+                                 if self.can_inline(*function[1:])}
+
+    def can_inline(self, n_locals, body):
+        if len(body) > self.inline_threshold:
+            return False
+        depth = 0
+        reachable = True
+        for command in body:
+            if command.kind == CommandType.C_LABEL:
+                if reachable and depth != 0:
+                    return False
+                depth, reachable = 0, True
+                continue
+            if command.kind in (CommandType.C_PUSH, CommandType.C_POP) and command.arg1 == 'local' and \
+                    command.arg2 >= n_locals:
+                return False
+            if command.kind == CommandType.C_RETURN:
+                if reachable and depth != 1:
+                    return False
+                reachable = False
+                continue
+            effect = STACK_EFFECTS.get(command.arg1 if command.kind == CommandType.C_ARITHMETIC else command.kind)
+            if effect is None:
+                return False
+            if not reachable:
+                continue
+            depth += effect
+            if depth < 0 or command.kind in (CommandType.C_GOTO, CommandType.C_IF) and depth != 0:
+                return False
+            if command.kind == CommandType.C_GOTO:
+                reachable = False
+        return not reachable
+
+    # Whether a call with n_args arguments from file_name can be inlined. Statics belong to the file of the
+    # function, so a body that uses them is only inlined within that file
+    def can_inline_call(self, function_name, n_args, file_name):
+        if function_name not in self.inline_functions:
+            return False
+        function_file, n_locals, body = self.inline_functions[function_name]
+        pointers = {command.arg2 for command in body if command.kind == CommandType.C_POP and command.arg1 == 'pointer'}
+        for command in body:
+            if command.kind in (CommandType.C_PUSH, CommandType.C_POP):
+                if command.arg1 == 'static' and function_file != file_name:
+                    return False
+                if command.arg1 == 'argument' and command.arg2 >= n_args:
+                    return False
+        return n_args + n_locals + len(pointers) <= len(self.free_temps)
+
+    # Replaces the calls to inline functions in the commands of the current file with the function bodies
+    def inline_calls(self, commands):
+        for command in commands:
+            if command.kind == CommandType.C_CALL and self.can_inline_call(command.arg1, command.arg2, self.file):
+                yield from self.write_inline_body(command.arg1, command.arg2, command.line_num)
+            else:
+                yield command
+
+    # The VM commands that run the body of function_name in place of a call. The arguments are popped into temp
+    # slots and argument/local accesses go to those slots; THIS and THAT are saved when the body sets them, since
+    # return would restore them. Labels get a prefix unique to the call site, and a return before the end of the
+    # body jumps to the end
+    def write_inline_body(self, function_name, n_args, line_num=None):
+        _, n_locals, body = self.inline_functions[function_name]
+        slots = iter(self.free_temps)
+        arguments = [next(slots) for _ in range(n_args)]
+        local_slots = [next(slots) for _ in range(n_locals)]
+        saved = {pointer: next(slots) for pointer in sorted({command.arg2 for command in body
+                                                             if command.kind == CommandType.C_POP and
+                                                             command.arg1 == 'pointer'})}
+        self.inline_count += 1
+        prefix = f'{function_name}$inline.{self.file}.{self.inline_count}'
+
+        res = [f'pop temp {slot}' for slot in reversed(arguments)]
+        for slot in local_slots:
+            res.extend(['push constant 0', f'pop temp {slot}'])
+        for pointer, slot in saved.items():
+            res.extend([f'push pointer {pointer}', f'pop temp {slot}'])
+
+        early_return = False
+        for position, command in enumerate(body):
+            keyword = command.line.split()[0]
+            if command.kind in (CommandType.C_PUSH, CommandType.C_POP) and command.arg1 in ('argument', 'local'):
+                slot = (arguments if command.arg1 == 'argument' else local_slots)[command.arg2]
+                res.append(f'{keyword} temp {slot}')
+            elif command.kind in (CommandType.C_LABEL, CommandType.C_GOTO, CommandType.C_IF):
+                res.append(f'{keyword} {prefix}${command.arg1}')
+            elif command.kind == CommandType.C_RETURN:
+                if position < len(body) - 1:
+                    res.append(f'goto {prefix}$end')
+                    early_return = True
+            else:
+                res.append(command.line)
+        if early_return:
+            res.append(f'label {prefix}$end')
+
+        for pointer, slot in saved.items():
+            res.extend([f'push temp {slot}', f'pop pointer {pointer}'])
+        return [Parser.tokenize(line, line_num) for line in res]
+
+    # Constant folding and propagation over the commands of the current file
+    # Pushed constants are held back while the commands that follow them can be evaluated at translation time,
+    # with 16-bit wraparound: arithmetic-logical commands on constants, and if-goto on a constant, which becomes a
+    # goto or disappears. Segment entries last popped from a constant are pushed as that constant, until a
+    # command that could change them: a label or function (where control flow joins), a call, or a pop to
+    # this/that, which may point anywhere in RAM
+    def fold_constants(self, commands):
+        pending = []  # (value, line_num) of the constants pushed but not emitted yet, topmost last
+        known = {}  # (segment, index) -> value of segment entries that hold a known constant
+
+        def flush():
+            # Constants from 0x8000 up do not fit an A-instruction and are pushed as the complement of one that does
+            for value, line_num in pending:
+                if value < 0x8000:
+                    yield Parser.tokenize(f'push constant {value}', line_num)
+                else:
+                    yield Parser.tokenize(f'push constant {~value & 0xFFFF}', line_num)
+                    yield Parser.tokenize('not', line_num)
+            pending.clear()
+
+        for command in commands:
+            kind = command.kind
+            key = (command.arg1, command.arg2)
+            name = command.arg1 if kind == CommandType.C_ARITHMETIC else None
+
+            if kind == CommandType.C_PUSH and (command.arg1 == 'constant' or key in known):
+                value = command.arg2 & 0xFFFF if command.arg1 == 'constant' else known[key]
+                pending.append((value, command.line_num))
+                continue
+            if name in FOLD_UNARY and pending:
+                x, line_num = pending.pop()
+                pending.append((FOLD_UNARY[name](x), line_num))
+                continue
+            if name in FOLD_BINARY and len(pending) >= 2:
+                y, _ = pending.pop()
+                x, line_num = pending.pop()
+                pending.append((FOLD_BINARY[name](x, y), line_num))
+                continue
+            if name in FOLD_BINARY and pending and pending[-1][0] == FOLD_IDENTITIES.get(name):
+                pending.pop()
+                continue
+            if kind == CommandType.C_IF and pending:
+                if pending.pop()[0]:
+                    yield from flush()
+                    yield Parser.tokenize(f'goto {command.arg1}', command.line_num)
+                    known.clear()
+                continue
+
+            value = pending[-1][0] if kind == CommandType.C_POP and pending else None
+            yield from flush()
+            yield command
+
+            if kind == CommandType.C_POP:
+                if command.arg1 in ('this', 'that'):
+                    known.clear()
+                elif value is None:
+                    known.pop(key, None)
+                else:
+                    known[key] = value
+            elif kind in (CommandType.C_LABEL, CommandType.C_GOTO, CommandType.C_FUNCTION, CommandType.C_CALL,
+                          CommandType.C_RETURN):
+                known.clear()
+
+        yield from flush()
 
     # Writes to the output file the assembly code that implements the given arithmetic-logical command
     def write_arithmetic(self):
@@ -194,17 +791,27 @@ class CodeWriter:
                     f'M={arithmetic_map[arg]}M']
 
         arithmetic_map = {'eq': 'JEQ', 'gt': 'JGT', 'lt': 'JLT'}
+        if arg in arithmetic_map and self.shared_compare:
+            label = self.new_label()
+            self.used_compares.add(arg)
+            res = [f'// {self.parser.current_line}',
+                   f'@{label}', 'D=A',
+                   f'@VM${arg.upper()}', '0;JMP',
+                   f'({label})']
+            self.rom_words_saved += 20 - rom_size(res)
+            return res
+
         if arg in arithmetic_map:
-            self.jump_count += 1
+            label = self.new_label()
             return [f'// {self.parser.current_line}',
                     '@SP', 'M=M-1', 'A=M', 'D=M',
                     '@SP', 'M=M-1', 'A=M', 'D=M-D',
-                    f'@LABEL{self.jump_count}', f'D;{arithmetic_map[arg]}',
+                    f'@{label}', f'D;{arithmetic_map[arg]}',
                     '@SP', 'A=M', 'M=0',
-                    f'@LABEL{self.jump_count}END', '0;JMP',
-                    f'(LABEL{self.jump_count})',
+                    f'@{label}END', '0;JMP',
+                    f'({label})',
                     '@SP', 'A=M', 'M=-1',
-                    f'(LABEL{self.jump_count}END)',
+                    f'({label}END)',
                     '@SP', 'M=M+1']
 
     # Writes to the output file the assembly code that implements the given push or pop command
@@ -232,7 +839,7 @@ class CodeWriter:
             if segment == 'temp':
                 return [
                     f'// {self.parser.current_line}',
-                    f'@{5 + int(i)}', 'D=A',  # // D=i
+                    f'@{5 + i}', 'D=M',  # // D=RAM[5+i]
                     '@SP', 'A=M', 'M=D',  # //RAM[SP] = RAM[addr]
                     '@SP', 'M=M+1']  # // SP++
 
@@ -244,7 +851,7 @@ class CodeWriter:
                     '@SP', 'M=M+1']  # // SP++
 
             if segment == 'pointer':
-                this_that = 'THIS' if i == '0' else 'THAT'
+                this_that = 'THIS' if i == 0 else 'THAT'
                 return [
                     f'// {self.parser.current_line}',
                     f'@{this_that}', 'D=M',  # // D=i
@@ -265,7 +872,7 @@ class CodeWriter:
             if segment == 'temp':
                 return [
                     f'// {self.parser.current_line}',
-                    f'@{5 + int(i)}', 'D=A',  # // D=i
+                    f'@{5 + i}', 'D=A',  # // D=i
                     '@R13', 'M=D',
                     '@SP', 'M=M-1',  # // SP--
                     'A=M', 'D=M',
@@ -278,25 +885,197 @@ class CodeWriter:
                     f'@{self.file}.{i}', 'M=D']
 
             if segment == 'pointer':
-                this_that = 'THIS' if i == '0' else 'THAT'
+                this_that = 'THIS' if i == 0 else 'THAT'
                 return [
                     f'// {self.parser.current_line}',
                     '@SP', 'M=M-1',  # // SP--
                     'A=M', 'D=M',  # D=RAM[SP]
                     f'@{this_that}', 'M=D']  # // THIS/THAT=RAM[SP]
 
+    # Peephole optimization over a window of VM commands starting at the current one
+    # Returns the fused assembly for the window and advances the parser past it, or None when no pattern applies:
+    #   push x, pop y           -> moves x to y without going through the stack
+    #   push x, add/sub/and/or  -> combines x with the stack top in place
+    #   push x, eq/gt/lt        -> compares the stack top with x in place
+    #   push x, neg/not         -> pushes -x or !x
+    #   push x, if-goto label   -> jumps on x without going through the stack
+    def write_fused(self):
+        if self.parser.command_type() != CommandType.C_PUSH:
+            return None
+        following = self.parser.peek()
+        if following is None:
+            return None
+
+        segment, i = self.parser.arg1(), self.parser.arg2()
+        # The arithmetic-logical command, or the type of any other command
+        command = following.arg1 if following.kind == CommandType.C_ARITHMETIC else following.kind
+        load = self.load_d(segment, i)
+        if load is None:
+            return None
+        comments = [f'// {self.parser.current_line}', f'// {following.line}']
+
+        if command == CommandType.C_POP:
+            store = self.store_d(following.arg1, following.arg2)
+            if store is None:
+                return None
+            prepare, store = store
+            res = comments + prepare + load + store
+        elif command in ('add', 'sub', 'and', 'or'):
+            if segment == 'constant' and i == 1 and command in ('add', 'sub'):
+                operation = 'M=M+1' if command == 'add' else 'M=M-1'
+                res = comments + ['@SP', 'A=M-1', operation]
+            else:
+                operation = {'add': 'M=D+M', 'sub': 'M=M-D', 'and': 'M=D&M', 'or': 'M=D|M'}[command]
+                res = comments + load + ['@SP', 'A=M-1', operation]
+        elif command in ('eq', 'gt', 'lt') and not self.shared_compare:
+            label = self.new_label()
+            jump = {'eq': 'JEQ', 'gt': 'JGT', 'lt': 'JLT'}[command]
+            res = comments + load + [
+                '@SP', 'A=M-1', 'D=M-D',
+                f'@{label}', f'D;{jump}',
+                '@SP', 'A=M-1', 'M=0',
+                f'@{label}END', '0;JMP',
+                f'({label})',
+                '@SP', 'A=M-1', 'M=-1',
+                f'({label}END)']
+        elif command in ('neg', 'not'):
+            operation = 'M=-D' if command == 'neg' else 'M=!D'
+            res = comments + load + ['@SP', 'M=M+1', 'A=M-1', operation]
+        elif command == CommandType.C_IF:
+            res = comments + load + [f'@{following.arg1}', 'D;JNE']
+        else:
+            return None
+
+        self.parser.advance()
+        return res
+
+    # Stack-top caching: translates the current command with the top of the stack kept in D
+    # While self.top_in_d is set, D holds the top value and SP points at the slot it would occupy in RAM
+    # Returns None for the commands that need the whole stack in RAM (labels, goto, function, call, return),
+    # which translate_file translates as usual after flushing D
+    def write_cached(self):
+        command_type = self.parser.command_type()
+        comment = [f'// {self.parser.current_line}']
+        # Brings the top of the stack into D when it is still in RAM
+        pop_top = [] if self.top_in_d else ['@SP', 'AM=M-1', 'D=M']
+
+        if command_type == CommandType.C_PUSH:
+            load = self.load_d(self.parser.arg1(), self.parser.arg2())
+            if load is None:
+                return None
+            res = comment + self.flush_top() + load
+            self.top_in_d = True
+            return res
+
+        if command_type == CommandType.C_POP:
+            store = self.store_d(self.parser.arg1(), self.parser.arg2())
+            if store is None:
+                return None
+            prepare, store = store
+            if self.top_in_d and prepare:
+                # The target address is computed through D, so the value waits in R14
+                res = comment + ['@R14', 'M=D'] + prepare + ['@R14', 'D=M'] + store
+            else:
+                res = comment + prepare + pop_top + store
+            self.top_in_d = False
+            return res
+
+        if command_type == CommandType.C_IF:
+            res = comment + pop_top + [f'@{self.parser.arg1()}', 'D;JNE']
+            self.top_in_d = False
+            return res
+
+        if command_type != CommandType.C_ARITHMETIC:
+            return None
+
+        arg = self.parser.arg1()
+        if arg in ('add', 'sub', 'and', 'or'):
+            operation = {'add': 'D=D+M', 'sub': 'D=M-D', 'and': 'D=D&M', 'or': 'D=D|M'}[arg]
+            res = comment + pop_top + ['@SP', 'AM=M-1', operation]
+        elif arg in ('neg', 'not'):
+            operation = '-' if arg == 'neg' else '!'
+            res = comment + ([f'D={operation}D'] if self.top_in_d else ['@SP', 'AM=M-1', f'D={operation}M'])
+        elif arg in ('eq', 'gt', 'lt') and not self.shared_compare:
+            label = self.new_label()
+            jump = {'eq': 'JEQ', 'gt': 'JGT', 'lt': 'JLT'}[arg]
+            res = comment + pop_top + [
+                '@SP', 'AM=M-1', 'D=M-D',
+                f'@{label}', f'D;{jump}',
+                'D=0',
+                f'@{label}END', '0;JMP',
+                f'({label})',
+                'D=-1',
+                f'({label}END)']
+        else:
+            return None
+
+        self.top_in_d = True
+        return res
+
+    # Writes the cached stack top from D back to RAM, if there is one
+    def flush_top(self):
+        if not self.top_in_d:
+            return []
+        self.top_in_d = False
+        return ['@SP', 'AM=M+1', 'A=A-1', 'M=D']
+
+    # Returns the instructions that load the value of segment[i] into D, or None for an unknown segment
+    def load_d(self, segment, i):
+        if segment == 'constant':
+            return ['D=0'] if i == 0 else ['D=1'] if i == 1 else [f'@{i}', 'D=A']
+        if segment in self.ram_map:
+            if i <= 3:
+                return [f'@{self.ram_map[segment]}', 'A=M'] + ['A=A+1'] * i + ['D=M']
+            return [f'@{i}', 'D=A', f'@{self.ram_map[segment]}', 'A=D+M', 'D=M']
+        if segment in ('temp', 'static', 'pointer'):
+            return [f'@{self.address(segment, i)}', 'D=M']
+        return None
+
+    # Returns (prepare, store) instructions that write D to segment[i], or None for an unknown segment
+    # prepare runs before D is loaded, for targets whose address has to be computed in advance
+    def store_d(self, segment, i):
+        if segment in self.ram_map:
+            if i <= 5:
+                return [], [f'@{self.ram_map[segment]}', 'A=M'] + ['A=A+1'] * i + ['M=D']
+            return ([f'@{i}', 'D=A', f'@{self.ram_map[segment]}', 'D=D+M', '@R13', 'M=D'],
+                    ['@R13', 'A=M', 'M=D'])
+        if segment in ('temp', 'static', 'pointer'):
+            return [], [f'@{self.address(segment, i)}', 'M=D']
+        return None
+
+    # Returns the symbol or address of a fixed-location segment entry
+    def address(self, segment, i):
+        if segment == 'temp':
+            return 5 + i
+        if segment == 'static':
+            return f'{self.file}.{i}'
+        return 'THIS' if i == 0 else 'THAT'
+
+    # Returns a new label for the branches of a template, unique within the program
+    def new_label(self):
+        self.jump_count += 1
+        return f'{self.file}$LABEL{self.jump_count}'
+
     # Informs that the translation of a new VM file has started (called by the VMTranslator)
     def set_file_name(self, string):
         self.file = string
 
     def write_init(self):
-        return [
-            # SP = 256
-            '@256', 'D=A',
-            '@SP', 'M=D',
+        if self.shared_calls:
+            call = self.write_shared_call('Sys.init', 0, 'Sys.init$ret.0')
+            self.rom_words_saved += rom_size(self.write_init_call()) - rom_size(call)
+            self.uses_shared_calls = True
+            return ['@256', 'D=A',
+                    '@SP', 'M=D',
+                    '// Call Sys.init'] + call + ['(Sys.init$ret.0)']
+
+        return ['@256', 'D=A',
+                '@SP', 'M=D',
+                '// Call Sys.init'] + self.write_init_call() + ['(Sys.init$ret.0)']
 
-            # Call Sys.init
-            '// Call Sys.init',
+    # The inline frame setup of the bootstrap call to Sys.init
+    def write_init_call(self):
+        return [
             # push returnAddrLabel
             '@Sys.init$ret.0', 'D=A',
             '@SP', 'A=M', 'M=D',
@@ -329,10 +1108,7 @@ class CodeWriter:
             '@LCL', 'M=D',
 
             # goto Sys.init
-            '@Sys.init', '0;JMP',
-
-            # (returnAddrLabel)
-            '(Sys.init$ret.0)']
+            '@Sys.init', '0;JMP']
 
     # Writes assembly code that effects the label command
     def write_label(self):
@@ -358,7 +1134,7 @@ class CodeWriter:
     # Writes assembly code that effects the function command
     def write_function(self):
         function_name = self.parser.arg1()
-        n_vars = int(self.parser.arg2())
+        n_vars = self.parser.arg2()
 
         res = [f'// {self.parser.current_line}',
                # f'({self.file}.{function_name})']  # (Foo.bar)
@@ -377,14 +1153,20 @@ class CodeWriter:
         # print('call_function_name', function_name)
         n_vars = self.parser.arg2()
 
-        if function_name not in self.call_count:
-            self.call_count[function_name] = 0
-        self.call_count[function_name] += 1
+        self.call_count += 1
+        function_name_ret = f'{self.file}$ret.{self.call_count}'
 
-        function_name_ret = f'{function_name}$ret.{self.call_count[function_name]}'
-
-        return [f'// {self.parser.current_line}',
+        res = [f'// {self.parser.current_line}'] + self.write_inline_call(function_name, n_vars, function_name_ret)
+        if self.shared_calls:
+            shared = self.write_shared_call(function_name, n_vars, function_name_ret)
+            self.rom_words_saved += rom_size(res) - rom_size(shared)
+            self.uses_shared_calls = True
+            res = [f'// {self.parser.current_line}'] + shared
+        return res + [f'({function_name_ret})']
 
+    # Pushes the frame and jumps to the function, inline at the call site
+    def write_inline_call(self, function_name, n_vars, function_name_ret):
+        return [
                 # push returnAddrLabel
                 f'@{function_name_ret}', 'D=A',
                 '@SP', 'A=M', 'M=D',
@@ -418,15 +1200,78 @@ class CodeWriter:
                 '@LCL', 'M=D',
 
                 # goto functionName
-                f'@{function_name}', '0;JMP',
+                f'@{function_name}', '0;JMP']
 
-                # (returnAddrLabel)
-                f'({function_name_ret})']
+    # Passes the function in R13, nArgs in R14 and the return address in D to the shared call routine
+    def write_shared_call(self, function_name, n_vars, function_name_ret):
+        n_args = ['@R14', f'M={n_vars}'] if n_vars in (0, 1) else [f'@{n_vars}', 'D=A', '@R14', 'M=D']
+        return [f'@{function_name}', 'D=A', '@R13', 'M=D'] + n_args + [
+            f'@{function_name_ret}', 'D=A',
+            '@VM$CALL', '0;JMP']
+
+    # The shared routines the program uses, emitted once per program
+    def write_shared_routines(self):
+        res = []
+        if self.uses_shared_calls:
+            res.extend(self.write_shared_call_routines())
+        for arg in sorted(self.used_compares):
+            res.extend(self.write_shared_compare_routine(arg))
+        return res
+
+    def write_shared_call_routines(self):
+        return ['// shared call routine: D = return address, R13 = function, R14 = nArgs',
+                '(VM$CALL)',
+                # push returnAddrLabel, LCL, ARG, THIS, THAT
+                '@SP', 'A=M', 'M=D',
+                '@LCL', 'D=M', '@SP', 'AM=M+1', 'M=D',
+                '@ARG', 'D=M', '@SP', 'AM=M+1', 'M=D',
+                '@THIS', 'D=M', '@SP', 'AM=M+1', 'M=D',
+                '@THAT', 'D=M', '@SP', 'AM=M+1', 'M=D',
+                '@SP', 'M=M+1',
+
+                # ARG = SP - 5 - nArgs
+                'D=M', '@5', 'D=D-A',
+                '@R14', 'D=D-M',
+                '@ARG', 'M=D',
+
+                # LCL = SP
+                '@SP', 'D=M',
+                '@LCL', 'M=D',
+
+                # goto function
+                '@R13', 'A=M', '0;JMP',
+
+                '// shared return routine',
+                '(VM$RETURN)'] + self.write_inline_return()
+
+    # Shared eq/gt/lt routine: D = return address. Replaces the two stack operands with the result
+    def write_shared_compare_routine(self, arg):
+        name = f'VM${arg.upper()}'
+        jump = {'eq': 'JEQ', 'gt': 'JGT', 'lt': 'JLT'}[arg]
+        return [f'// shared {arg} routine: D = return address',
+                f'({name})',
+                '@R15', 'M=D',
+                '@SP', 'AM=M-1', 'D=M',
+                'A=A-1', 'D=M-D',
+                f'@{name}.TRUE', f'D;{jump}',
+                '@SP', 'A=M-1', 'M=0',
+                '@R15', 'A=M', '0;JMP',
+                f'({name}.TRUE)',
+                '@SP', 'A=M-1', 'M=-1',
+                '@R15', 'A=M', '0;JMP']
 
     # Writes assembly code that effects the return command
     def write_return(self):
-        return [f'// {self.parser.current_line}',
+        if self.shared_calls:
+            self.rom_words_saved += rom_size(self.write_inline_return()) - 2
+            self.uses_shared_calls = True
+            return [f'// {self.parser.current_line}',
+                    '@VM$RETURN', '0;JMP']
+        return [f'// {self.parser.current_line}'] + self.write_inline_return()
 
+    # Restores the caller's frame and jumps back to it, inline at the return site
+    def write_inline_return(self):
+        return [
                 # endFrame = LCL
                 '@LCL', 'D=M',
                 '@R13', 'M=D',
@@ -459,6 +1304,17 @@ class CodeWriter:
                 # goto retAddr
                 '@R14', 'A=M', '0;JMP']
 
+    # The write_* method for each command type, for the dispatch in generate_file
+    WRITERS = {CommandType.C_ARITHMETIC: write_arithmetic,
+               CommandType.C_PUSH: write_push_pop,
+               CommandType.C_POP: write_push_pop,
+               CommandType.C_LABEL: write_label,
+               CommandType.C_GOTO: write_goto,
+               CommandType.C_IF: write_if,
+               CommandType.C_FUNCTION: write_function,
+               CommandType.C_RETURN: write_return,
+               CommandType.C_CALL: write_call}
+
 
 if __name__ == '__main__':
     # files = ['ProgramFlow/BasicLoop/BasicLoop.vm', 'ProgramFlow/FibonacciSeries/FibonacciSeries.vm',
@@ -466,8 +1322,46 @@ if __name__ == '__main__':
     #          'FunctionCalls/FibonacciElement', 'FunctionCalls/StaticsTest']
     # vm_translator = VMTranslator(files[5])
 
-    args = sys.argv
-    if len(args) < 1:
-        print('Need file name')
-
-    vm_translator = VMTranslator(args[1])
+    arg_parser = argparse.ArgumentParser(description='Translates a .vm file or a directory of .vm files to .asm.')
+    arg_parser.add_argument('path')
+    arg_parser.add_argument('-O', '--optimize', action='store_true', help='fuse common command sequences')
+    arg_parser.add_argument('--shared-calls', action='store_true',
+                            help='share one call routine and one return routine instead of inlining them')
+    arg_parser.add_argument('--shared-compare', action='store_true',
+                            help='share one routine per comparison kind instead of inlining eq/gt/lt')
+    arg_parser.add_argument('--cache-top', action='store_true',
+                            help='keep the top of the stack in D between commands')
+    arg_parser.add_argument('--prune', action='store_true',
+                            help='leave out the functions Sys.init never calls, directly or indirectly')
+    arg_parser.add_argument('--inline', action='store_true', help='replace calls to small leaf functions by their body')
+    arg_parser.add_argument('--inline-threshold', type=int, default=INLINE_THRESHOLD, metavar='N',
+                            help='largest function body to inline, in VM commands (default: %(default)s)')
+    arg_parser.add_argument('--fold', action='store_true', help='evaluate constant expressions at translation time')
+    arg_parser.add_argument('--source-map', action='store_true',
+                            help='write the VM source of each range of .asm lines to a .asm.map file')
+    arg_parser.add_argument('--report', metavar='PATH',
+                            help='write the ROM words and estimated cycles by command, function and file as JSON')
+    arg_parser.add_argument('--stream', action='store_true',
+                            help='write each line as soon as it is generated instead of building the program first')
+    arg_parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                            help='worker processes for the files of a directory (default: one per core)')
+    args = arg_parser.parse_args()
+
+    vm_translator = VMTranslator(args.path, optimize=args.optimize, shared_calls=args.shared_calls,
+                                 shared_compare=args.shared_compare, cache_top=args.cache_top,
+                                 prune=args.prune, inline=args.inline, inline_threshold=args.inline_threshold,
+                                 fold=args.fold, jobs=args.jobs,
+                                 streaming=args.stream, source_map=args.source_map,
+                                 cost_report=args.report is not None)
+
+    if args.shared_calls or args.shared_compare:
+        code_writer = vm_translator.code_writer
+        print(f'ROM size: {code_writer.rom_size + code_writer.rom_words_saved} words inline, '
+              f'{code_writer.rom_size} words with shared routines')
+
+    for function_name in vm_translator.code_writer.removed_functions:
+        print(f'removed unreachable function {function_name}')
+
+    if args.report:
+        with open(args.report, 'w', encoding="utf-8") as report_file:
+            json.dump(vm_translator.code_writer.cost_summary(), report_file, indent=2, sort_keys=True)